@@ -1,9 +1,13 @@
+import asyncio
 import logging
+from datetime import datetime
 
 import click
 
+from simulator.amm.result_cache import ResultCache
 from simulator.calculation import Calculator
 from simulator.import_data import BinanceImporter
+from simulator.import_data.fake_binance import benchmark_import, check_import
 from simulator.logging import setup_logger
 from simulator.settings import Pair
 
@@ -18,13 +22,63 @@ def simulator_commands(): ...
 
 @simulator_commands.command("import_data", short_help="import price data")
 @click.argument("pair", type=click.STRING)
-def import_data(pair: str) -> None:
-    BinanceImporter.run(Pair(pair))
+@click.option("--incremental", is_flag=True, help="Fetch only data missing in the existing dataset")
+def import_data(pair: str, incremental: bool) -> None:
+    BinanceImporter.run(Pair(pair), incremental)
+
+
+@simulator_commands.command("benchmark_import", short_help="benchmark import against a local fake API")
+@click.option("--days", type=click.FLOAT, default=60, help="Days of klines to fetch")
+@click.option("--fixed", is_flag=True, help="Keep the number of requests in flight fixed")
+@click.option("--concurrency", type=click.INT, default=8, help="Initial number of requests in flight")
+@click.option("--weight-limit", type=click.INT, default=200, help="Request weight budget of the fake API per window")
+@click.option("--window", type=click.FLOAT, default=2.0, help="Seconds of the weight window of the fake API")
+@click.option("--latency", type=click.FLOAT, default=0.2, help="Seconds of the fake API to answer")
+@click.option("--background-weight", type=click.INT, default=0, help="Weight used by other clients every window")
+def benchmark(
+    days: float, fixed: bool, concurrency: int, weight_limit: int, window: float, latency: float, background_weight: int
+) -> None:
+    """
+    Compare adaptive and fixed limits of requests in flight
+
+    Adaptive is not the fastest: when the import has the whole weight budget, a high fixed limit fetches faster,
+    since adaptive stops growing at 80% of the budget. What it buys is not being rate limited without tuning:
+    once other clients use part of the budget (--background-weight), high fixed limits get 429 responses
+    (and 418 bans from the real API if they go on), while adaptive gets none and is still faster than a low
+    fixed limit. Compare rows_per_second and rejected of runs with and without --fixed, for a few --concurrency
+    values, with and without --background-weight.
+    """
+    result = asyncio.run(
+        benchmark_import(
+            BinanceImporter,
+            days=days,
+            adaptive=not fixed,
+            concurrency=concurrency,
+            weight_limit=weight_limit,
+            window=window,
+            latency=latency,
+            background_weight=background_weight,
+        )
+    )
+    logger.info(f"Results: {result}")
+
+
+@simulator_commands.command("check_import", short_help="check resumable and incremental import with a local fake API")
+@click.option("--days", type=click.FLOAT, default=3, help="Days of klines to import")
+@click.option("--fail-after", type=click.INT, default=5, help="Requests before the fake API interrupts the import")
+def check_import_command(days: float, fail_after: int) -> None:
+    result = asyncio.run(check_import(BinanceImporter, days=days, fail_after=fail_after))
+    logger.info(f"Results: {result}")
+    if not (result["interrupted"] and result["resume_equal"] and result["incremental_equal"]):
+        raise click.ClickException("Imported rows differ from the fake API")
 
 
 # Change parameters before running
 @simulator_commands.command("calculate_A", short_help="import price data")
-def calculate_a() -> None:
+@click.option("--resume", is_flag=True, help="Continue unfinished points from the last checkpoints")
+@click.option("--cache", is_flag=True, help="Take finished points from the result cache and save new ones to it")
+@click.option("--checkpoint", is_flag=True, help="Save progress of unfinished points, to continue with --resume")
+def calculate_a(resume: bool, cache: bool, checkpoint: bool) -> None:
     """
     Iterate through range of A to find best A
 
@@ -34,6 +88,10 @@ def calculate_a() -> None:
     samples - number of samples to iterate through
     n_top_samples - number of top samples to choose (worst case)
     initial_liquidity_range - number of bands initially to have liquidity
+    use_threading - run samples on all cores
+    backend - "scalar" (LendingAMM per sample) or "batch" (vectorized over samples)
+    seed - seed of simulated windows, runs with the same seed are reproducible (and served from the result cache with
+        --cache)
     """
 
     results = Calculator.simulate_A(
@@ -43,9 +101,72 @@ def calculate_a() -> None:
         n_top_samples=50,
         dynamic_fee_multiplier=0.25,
         initial_liquidity_range=4,
+        use_threading=True,
+        backend="batch",
+        seed=0,
+        resume=resume,
+        use_cache=cache,
+        checkpoint=checkpoint,
     )
     logger.info(f"Results: {results}")
 
 
+@simulator_commands.command("optimize", short_help="search parameter with minimal liquidation discount")
+@click.option(
+    "--parameter",
+    type=click.Choice(["A", "initial_liquidity_range", "dynamic_fee_multiplier"]),
+    default="A",
+    help="Parameter to search, others are fixed below",
+)
+@click.option("--low", type=click.FLOAT, default=30, help="Lowest value of the parameter")
+@click.option("--high", type=click.FLOAT, default=500, help="Highest value of the parameter")
+@click.option("--cache", is_flag=True, help="Take simulated points from the result cache and save new ones to it")
+def optimize(parameter: str, low: float, high: float, cache: bool) -> None:
+    """
+    Screen parameter values with few samples, then refine near the minimum with golden-section search
+    """
+    result = Calculator.optimize(
+        pair="BTCUSDT",
+        t_exp=600,
+        parameter=parameter,
+        low=low,
+        high=high,
+        samples=500_000,
+        n_top_samples=50,
+        a=None if parameter == "A" else 100,
+        dynamic_fee_multiplier=0.25,
+        initial_liquidity_range=4,
+        use_threading=True,
+        backend="batch",
+        seed=0,
+        use_cache=cache,
+    )
+    logger.info(f"Results: {result}")
+
+
+@simulator_commands.command("cache_info", short_help="show result cache usage")
+def cache_info() -> None:
+    info = ResultCache().info()
+    for key in ("least_recently_used", "most_recently_used"):
+        if info[key] is not None:
+            info[key] = datetime.fromtimestamp(info[key]).strftime("%Y/%m/%d %H:%M")
+    logger.info(f"Result cache: {info}")
+
+
+@simulator_commands.command("cache_prune", short_help="remove old result cache entries")
+@click.option("--max-size", type=click.FLOAT, default=None, help="Keep at most this many MB, least recently used go")
+@click.option("--max-age", type=click.FLOAT, default=None, help="Remove entries unused for more days")
+@click.option("--all", "remove_all", is_flag=True, help="Remove everything")
+def cache_prune(max_size: float | None, max_age: float | None, remove_all: bool) -> None:
+    cache = ResultCache()
+    if remove_all:
+        max_size = 0
+    removed = cache.prune(
+        max_size=int(max_size * 2**20) if max_size is not None else cache.max_size,
+        max_age=max_age * 86400 if max_age is not None else None,
+    )
+    logger.info(f"Removed {removed} result cache entries.")
+
+
 if __name__ == "__main__":
     simulator_commands()
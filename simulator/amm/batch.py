@@ -0,0 +1,448 @@
+from math import log, sqrt
+
+import numpy as np
+
+from .band_decomposition import get_range_losses
+from .lending_amm import LendingAMM
+from .price_data import PriceData
+from .range_index import QuietWindowIndex
+
+
+class BatchLendingAMM:
+    """
+    Many independent LendingAMM states advanced in lockstep, samples are the leading dimension of all arrays
+
+    Every sample has liquidity in n_bands bands starting from its own min_band, like after
+    LendingAMM.deposit_nrange. Formulas mirror LendingAMM, methods take `idx` - indices of samples to work on.
+    Samples which would raise in LendingAMM (e.g. active band exceeding 500) are marked as failed and skipped.
+    """
+
+    BAND_OFFSET = LendingAMM.BAND_OFFSET
+
+    def __init__(self, p_base: np.ndarray, A: int, dynamic_fee_multiplier: float | None, n_bands: int):
+        n_samples = len(p_base)
+        self.p_base = np.asarray(p_base, dtype=np.float64)
+        self.A = A
+        self.dynamic_fee_multiplier = dynamic_fee_multiplier if dynamic_fee_multiplier is not None else 0.25
+        self.n_bands = n_bands
+        self.x = np.zeros((n_samples, n_bands))
+        self.y = np.zeros((n_samples, n_bands))
+        self.active_band = np.zeros(n_samples, dtype=np.int64)
+        self.min_band = np.zeros(n_samples, dtype=np.int64)
+        self.failed = np.zeros(n_samples, dtype=bool)
+
+        self.log_k = log((A - 1) / A)
+        self.sqrt_band_ratio = sqrt(A / (A - 1))
+        # Same values as used by LendingAMM, so that results match
+        self.k_powers = np.asarray(LendingAMM._get_k_powers(A))
+
+        self.p_oracle = self.p_base.copy()
+        self.p_oracle_2 = self.p_oracle**2
+        self.p_oracle_3 = self.p_oracle**3
+
+    def set_p_oracle(self, idx: np.ndarray, p: np.ndarray):
+        self.p_oracle[idx] = p
+        self.p_oracle_2[idx] = p**2
+        self.p_oracle_3[idx] = p**3
+
+    def get_band_n(self, idx: np.ndarray, p: np.ndarray) -> np.ndarray:
+        return np.floor(np.log(p / self.p_base[idx]) / self.log_k).astype(np.int64)
+
+    def deposit_nrange(self, amount: float, p: np.ndarray, dn: int):
+        idx = np.arange(len(self.p_base))
+        n_top = self.get_band_n(idx, self.p_oracle) + 1
+        assert np.all(p <= self.p_oracle)
+        n1 = np.maximum(self.get_band_n(idx, p), n_top)
+        self.min_band = n1
+        self.y += amount / dn
+        self.failed |= (n1 <= -self.BAND_OFFSET) | (n1 + dn - 1 >= self.BAND_OFFSET)
+
+        # p_top of bands with liquidity and of the one above them, squared as in p_up / p_down
+        n = np.clip(n1[:, None] + np.arange(dn + 1), -self.BAND_OFFSET, self.BAND_OFFSET)
+        self.band_p_top_2 = (self.p_base[:, None] * self.k_powers[n + self.BAND_OFFSET]) ** 2
+
+    def _k_power(self, n: np.ndarray) -> np.ndarray:
+        # Bands of samples which are not failed are within -500..500
+        return self.k_powers[n + self.BAND_OFFSET]
+
+    def p_top(self, idx: np.ndarray, n: np.ndarray) -> np.ndarray:
+        return self.p_base[idx] * self._k_power(n)
+
+    def p_down(self, idx: np.ndarray, n: np.ndarray) -> np.ndarray:
+        return self.p_oracle_3[idx] / (self.p_base[idx] * self._k_power(n)) ** 2
+
+    def p_up(self, idx: np.ndarray, n: np.ndarray) -> np.ndarray:
+        return self.p_oracle_3[idx] / (self.p_base[idx] * self._k_power(n + 1)) ** 2
+
+    def _fee(self, p_oracle: np.ndarray, p_up: np.ndarray) -> np.ndarray:
+        return (
+            np.where(p_oracle > p_up, (p_oracle - p_up) / p_oracle, (p_up - p_oracle) / p_up)
+            * self.dynamic_fee_multiplier
+        )
+
+    def dynamic_fee(self, idx: np.ndarray, n: np.ndarray) -> np.ndarray:
+        return self._fee(self.p_oracle[idx], self.p_up(idx, n))
+
+    def get_band_xy(self, idx: np.ndarray, n: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        x, y of band n and its column in self.x / self.y (-1 for bands without liquidity)
+        """
+        col = n - self.min_band[idx]
+        inside = (col >= 0) & (col < self.n_bands)
+        col = np.where(inside, col, -1)
+        flat = idx * self.n_bands + np.where(inside, col, 0)
+        x = np.where(inside, self.x.ravel().take(flat), 0.0)
+        y = np.where(inside, self.y.ravel().take(flat), 0.0)
+        return x, y, col
+
+    def get_y0(self, idx, n, x, y):
+        A = self.A
+        p_o = self.p_oracle[idx]
+        p_top = self.p_top(idx, n)
+        a = p_o * A
+        b = p_top / p_o * (A - 1) * x + self.p_oracle_2[idx] / p_top * A * y
+        D = b**2 + 4 * a * x * y
+        return (b + np.sqrt(D)) / (2 * a)
+
+    def get_fg(self, idx, n, y0):
+        p_top = self.p_top(idx, n)
+        f = y0 * self.p_oracle_2[idx] / p_top * self.A
+        g = y0 * p_top / self.p_oracle[idx] * (self.A - 1)
+        return f, g
+
+    def get_p(self, idx: np.ndarray) -> np.ndarray:
+        n = self.active_band[idx]
+        x, y, _ = self.get_band_xy(idx, n)
+        empty = (x == 0) & (y == 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f, g = self.get_fg(idx, n, self.get_y0(idx, n, x, y))
+            return np.where(empty, (self.p_up(idx, n) * self.p_down(idx, n)) ** 0.5, (f + x) / (g + y))
+
+    def find_target_prices(self, idx: np.ndarray, high: np.ndarray, low: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        LendingAMM.find_target_price for up (high) and down (low) directions, checks all bands with liquidity at once
+        """
+        rows = np.arange(len(idx))
+        # p_down of band j is band_prices[:, j], p_up is band_prices[:, j + 1]
+        band_prices = self.p_oracle_3[idx, None] / self.band_p_top_2[idx]
+        p_down = band_prices[:, :-1]
+        p_up = band_prices[:, 1:]
+        fee = self._fee(self.p_oracle[idx, None], p_up)
+
+        # Highest band with p > p_down * (1 + fee), or fee of min_band when price is outside of liquidity
+        hit = high[:, None] > p_down * (1 + fee)
+        band = self.n_bands - 1 - np.argmax(hit[:, ::-1], axis=1)
+        high_fee = np.where(hit.any(axis=1), fee[rows, band], fee[:, 0])
+
+        # Lowest band with p < p_up * (1 - fee), or fee of max_band when price is outside of liquidity
+        hit = low[:, None] < p_up * (1 - fee)
+        band = np.argmax(hit, axis=1)
+        low_fee = np.where(hit.any(axis=1), fee[rows, band], fee[:, -1])
+
+        return high * (1 - high_fee), low * (1 + low_fee)
+
+    def _skip_empty_bands(self, idx, n, price, bstep) -> np.ndarray:
+        """
+        Band where LendingAMM.trade_to_price stops walking over empty bands starting from empty band n:
+        the band containing price or the first band with liquidity in bstep direction
+
+        If price is not in bstep direction (possible with negative dynamic fees), the walk goes one band further,
+        as LendingAMM does.
+        """
+        # p_down(c) <= price <= p_up(c) => c = floor(log(p_oracle**3 / (p_base**2 * price)) / (2 * log(k)))
+        p_base = self.p_base[idx]
+        c = np.floor(np.log(self.p_oracle_3[idx] / (p_base**2 * price)) / (2 * self.log_k))
+        c = np.clip(c, -self.BAND_OFFSET, self.BAND_OFFSET - 1).astype(np.int64)
+        # Fix rounding at band edges
+        c = np.where(price < self.p_down(idx, c), c - 1, np.where(price > self.p_up(idx, c), c + 1, c))
+
+        min_band = self.min_band[idx]
+        max_band = min_band + self.n_bands - 1
+        no_band = np.where(bstep == 1, self.BAND_OFFSET, -self.BAND_OFFSET)  # walks until band assertion
+
+        up_stop = np.where(n < min_band, min_band, no_band)
+        up_stop = np.minimum(np.where(c > n, c, no_band), up_stop)
+        down_stop = np.where(n > max_band, max_band, no_band)
+        down_stop = np.maximum(np.where(c < n, c, no_band), down_stop)
+        new_n = np.where(bstep == 1, up_stop, down_stop)
+
+        # Empty band inside of liquidity range is not expected, go step by step there and when price is behind
+        step = ((n >= min_band) & (n <= max_band)) | ((c - n) * bstep <= 0)
+        return np.where(step, n + bstep, new_n)
+
+    def trade_to_price(self, idx: np.ndarray, price: np.ndarray, current_price: np.ndarray | None = None):
+        """
+        Same as LendingAMM.trade_to_price for samples idx, every iteration moves each sample by one band step
+
+        current_price - get_p(idx) if it is already known
+        """
+        if current_price is None:
+            current_price = self.get_p(idx)
+        keep = ~self.failed[idx]
+        idx, price, current_price = idx[keep], price[keep], current_price[keep]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            n = self.active_band[idx]
+            x, y, _ = self.get_band_xy(idx, n)
+            empty = (x == 0) & (y == 0)
+            bstep = np.where(
+                empty,
+                np.where(price > self.p_up(idx, n), 1, np.where(price < self.p_down(idx, n), -1, 0)),
+                np.where(price > current_price, 1, np.where(price < current_price, -1, 0)),
+            )
+            keep = bstep != 0
+            idx, price, bstep = idx[keep], price[keep], bstep[keep]
+            # LendingAMM walks over empty bands with the price including the fee of the last band it traded in
+            walk_price = price.copy()
+
+            while len(idx):
+                n = self.active_band[idx]
+                out_of_range = (n <= -self.BAND_OFFSET) | (n >= self.BAND_OFFSET)
+                if out_of_range.any():
+                    # "active band should not exceed 500" assertion in LendingAMM
+                    self.failed[idx[out_of_range]] = True
+                    keep = ~out_of_range
+                    idx, price, walk_price, bstep, n = idx[keep], price[keep], walk_price[keep], bstep[keep], n[keep]
+
+                x, y, col = self.get_band_xy(idx, n)
+                empty = (x == 0) & (y == 0)
+                done = np.zeros(len(idx), dtype=bool)
+
+                if empty.any():
+                    e = np.flatnonzero(empty)
+                    ie, ne, pe = idx[e], n[e], walk_price[e]
+                    in_band = (self.p_down(ie, ne) <= pe) & (pe <= self.p_up(ie, ne))
+                    done[e[in_band]] = True
+                    walk = e[~in_band]
+                    self.active_band[idx[walk]] = self._skip_empty_bands(
+                        idx[walk], n[walk], walk_price[walk], bstep[walk]
+                    )
+
+                t = np.flatnonzero(~empty)
+                if len(t):
+                    done[t], walk_price[t] = self._trade_in_band(idx[t], n[t], x[t], y[t], col[t], price[t], bstep[t])
+
+                keep = ~done
+                idx, price, walk_price, bstep = idx[keep], price[keep], walk_price[keep], bstep[keep]
+
+    def _trade_in_band(self, idx, n, x, y, col, price, bstep) -> tuple[np.ndarray, np.ndarray]:
+        """
+        One iteration of LendingAMM.trade_to_price loop for non-empty bands, returns mask of finished trades
+        and the price with the fee of the band
+        """
+        y0 = self.get_y0(idx, n, x, y)
+        f, g = self.get_fg(idx, n, y0)
+        Inv = (f + x) * (g + y)
+        fee = self.dynamic_fee(idx, n)
+        up = bstep == 1
+
+        # up: reduce y, increase x, go up
+        price_up = price * (1 - fee)
+        stop_up = up & (price_up < self.p_down(idx, n))
+        y_dest = (Inv / price_up) ** 0.5 - g
+        end_up = up & ~stop_up & (y_dest >= 0)
+        cross_up = up & ~stop_up & ~end_up
+
+        # down: increase y, reduce x, go down
+        price_down = price * (1 + fee)
+        stop_down = ~up & (price_down > self.p_up(idx, n))
+        x_dest = (Inv * price_down) ** 0.5 - f
+        end_down = ~up & ~stop_down & (x_dest >= 0)
+        cross_down = ~up & ~stop_down & ~end_down
+
+        new_x = np.select(
+            [end_up, cross_up, end_down, cross_down],
+            [Inv / (g + y_dest) - f, Inv / g - f, x_dest, 0.0],
+            x,
+        )
+        new_y = np.select(
+            [end_up, cross_up, end_down, cross_down],
+            [y_dest, 0.0, Inv / (f + x_dest) - g, Inv / f - g],
+            y,
+        )
+        # Fee stays in the band
+        new_x = np.where(end_up | cross_up, new_x + fee * (new_x - x), new_x)
+        new_y = np.where(end_down | cross_down, new_y + fee * (new_y - y), new_y)
+
+        self.x[idx, col] = new_x
+        self.y[idx, col] = new_y
+        self.active_band[idx] += np.where(cross_up, 1, np.where(cross_down, -1, 0))
+        return ~(cross_up | cross_down), np.where(up, price_up, price_down)
+
+    def get_all_x(self) -> np.ndarray:
+        """
+        LendingAMM.get_x_down summed over bands with liquidity for every sample
+        """
+        return self.get_bands_x().sum(axis=1)
+
+    def get_bands_x(self) -> np.ndarray:
+        """
+        LendingAMM.get_x_down of every band with liquidity, shape (samples, n_bands)
+        """
+        A = self.A
+        idx = np.arange(len(self.p_base))[:, None]
+        n = self.min_band[:, None] + np.arange(self.n_bands)
+        x = self.x
+        y = self.y
+        p_o = self.p_oracle[:, None]
+        p_o_up = self.p_top(idx, n)
+        p_o_down = p_o_up * (A - 1) / A
+        p_current_mid = p_o**3 / p_o_down**2 * (A - 1) / A
+        sqrt_band_ratio = self.sqrt_band_ratio
+        above = p_o > p_o_up
+        below = p_o < p_o_down
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Only x or only y, oracle outside of the band
+            y_equiv = np.where(y == 0, x / p_current_mid, y)
+            x_equiv = np.where(x == 0, y * p_current_mid, x)
+            single = np.where(above, y_equiv * p_o_up / sqrt_band_ratio, x_equiv)
+
+            y0 = self.get_y0(idx, n, x, y)
+            f, g = self.get_fg(idx, n, y0)
+            Inv = (f + x) * (g + y)
+            y_o = A * y0 * (1 - p_o_down / p_o)
+            x_o = np.maximum(Inv / (g + y_o), f) - f
+            mixed = np.select(
+                [above, below],
+                [(np.maximum(Inv / f, g) - g) * p_o_up / sqrt_band_ratio, np.maximum(Inv / g, f) - f],
+                x_o + y_o * np.sqrt(p_o_down * p_o),
+            )
+
+            value = np.where((x == 0) | (y == 0), np.where(above | below, single, mixed), mixed)
+            value = np.where((x == 0) & (y == 0), 0.0, value)
+
+        return value
+
+
+def simulate_batch(
+    prices: PriceData,
+    oracle_prices: np.ndarray,
+    start_indices: np.ndarray,
+    end_indices: np.ndarray,
+    A: int,
+    initial_liquidity_range: int,
+    dynamic_fee_multiplier: float | None = None,
+    position_shift: float = 0,
+    external_fee: float = 0.0,
+    quiet_window_index: QuietWindowIndex | None = None,
+) -> tuple[BatchLendingAMM, np.ndarray]:
+    """
+    Trade through prices[start_indices[i]:end_indices[i]] for all positions together
+
+    Same as Simulator.simulate_window with ConstantInitialLiquidity, up to float rounding: returns AMMs in the
+    final state and initial values of their bands. Positions for which single_run would raise are marked failed.
+    Windows which quiet_window_index (built with the same external_fee) marks as quiet are not simulated.
+    """
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    lengths = np.minimum(np.asarray(end_indices, dtype=np.int64), len(prices)) - start_indices
+    valid = (lengths > 0) & (start_indices >= 0)
+    start_indices = np.where(valid, start_indices, 0)
+
+    initial_y0 = 1.0
+    p0 = prices.open[start_indices] * (1 - position_shift)
+    p_base = p0 * (A / (A - 1) + 1e-4)
+    amm = BatchLendingAMM(p_base, A, dynamic_fee_multiplier, initial_liquidity_range)
+    amm.deposit_nrange(initial_y0, p0, initial_liquidity_range)
+    amm.failed |= ~valid
+    initial_bands_x = amm.get_bands_x()
+
+    quiet = np.zeros(len(lengths), dtype=bool)
+    if quiet_window_index is not None and amm.dynamic_fee_multiplier >= 0:
+        idx = np.flatnonzero(~amm.failed)
+        end = start_indices[idx] + lengths[idx]
+        quiet[idx] = quiet_window_index.is_quiet(start_indices[idx], end, amm.p_top(idx, amm.min_band[idx]))
+    # Reserves of quiet windows are not traded, only the last oracle price matters
+    last_indices = start_indices + lengths - 1
+    lengths = np.where(quiet, 0, lengths)
+
+    for step in range(int(lengths.max(initial=0))):
+        idx = np.flatnonzero((step < lengths) & ~amm.failed)
+        if not len(idx):
+            break
+        i = start_indices[idx] + step
+        amm.set_p_oracle(idx, oracle_prices[i])
+
+        high, low = amm.find_target_prices(idx, prices.high[i] * (1 - external_fee), prices.low[i] * (1 + external_fee))
+
+        p = amm.get_p(idx)
+        trade = high > p
+        amm.trade_to_price(idx[trade], high[trade], p[trade])
+
+        p = amm.get_p(idx)
+        trade = low < p
+        amm.trade_to_price(idx[trade], low[trade], p[trade])
+
+    idx = np.flatnonzero(quiet)
+    amm.set_p_oracle(idx, oracle_prices[last_indices[idx]])
+
+    return amm, initial_bands_x
+
+
+def run_batch(
+    prices: PriceData,
+    oracle_prices: np.ndarray,
+    start_indices: np.ndarray,
+    end_indices: np.ndarray,
+    A: int,
+    initial_liquidity_range: int,
+    dynamic_fee_multiplier: float | None = None,
+    position_shift: float = 0,
+    external_fee: float = 0.0,
+    quiet_window_index: QuietWindowIndex | None = None,
+) -> np.ndarray:
+    """
+    Losses of positions over prices[start_indices[i]:end_indices[i]], same as Simulator.single_run
+
+    Positions for which single_run would raise get nan.
+    """
+    amm, initial_bands_x = simulate_batch(
+        prices,
+        oracle_prices,
+        start_indices,
+        end_indices,
+        A,
+        initial_liquidity_range,
+        dynamic_fee_multiplier,
+        position_shift,
+        external_fee,
+        quiet_window_index,
+    )
+    loss = 1 - amm.get_all_x() / initial_bands_x.sum(axis=1)
+    loss[amm.failed] = np.nan
+    return loss
+
+
+def run_batch_ranges(
+    prices: PriceData,
+    oracle_prices: np.ndarray,
+    start_indices: np.ndarray,
+    end_indices: np.ndarray,
+    A: int,
+    initial_liquidity_ranges: list[int],
+    dynamic_fee_multiplier: float | None = None,
+    position_shift: float = 0,
+    external_fee: float = 0.0,
+    quiet_window_index: QuietWindowIndex | None = None,
+) -> np.ndarray:
+    """
+    Losses of positions for every range in initial_liquidity_ranges, same as Simulator.single_run_ranges
+
+    Returns array of shape (positions, ranges), failed positions get nan.
+    """
+    amm, initial_bands_x = simulate_batch(
+        prices,
+        oracle_prices,
+        start_indices,
+        end_indices,
+        A,
+        max(initial_liquidity_ranges),
+        dynamic_fee_multiplier,
+        position_shift,
+        external_fee,
+        quiet_window_index,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        losses = get_range_losses(initial_bands_x, amm.get_bands_x(), initial_liquidity_ranges)
+    losses[amm.failed] = np.nan
+    return losses
@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from simulator.settings import CHECKPOINT_DIR
+
+from .top_losses import TopLosses
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoints:
+    """
+    Partial results of unfinished runs, one json file per result key (see ResultCache.get_key)
+
+    A checkpoint is the merged TopLosses of finished chunks of the sample plan and indices of these chunks,
+    so a resumed run simulates only the remaining chunks and gets exactly the same result.
+    Saving is throttled to once per `interval` seconds for every key, starting with the first save.
+    """
+
+    def __init__(self, path: Path = CHECKPOINT_DIR, interval: float = 60.0):
+        self.path = path
+        self.interval = interval
+        self._saved_at: dict[str, float] = {}
+
+    def get_path(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def load(self, key: str, chunk_size: int) -> tuple[TopLosses, set[int]] | None:
+        """
+        Top losses and finished chunk indices, None if there is no checkpoint made with the same chunk size
+        """
+        try:
+            with open(self.get_path(key)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint["chunk_size"] != chunk_size:
+            logger.warning(f"Checkpoint {key} was made with chunk size {checkpoint['chunk_size']}, ignoring it")
+            return None
+        top_losses = TopLosses.from_dict(checkpoint["top_losses"])
+        logger.info(f"Resuming {key} from checkpoint: {top_losses.samples} samples done.")
+        return top_losses, set(checkpoint["done_chunks"])
+
+    def save(self, key: str, top_losses: TopLosses, done_chunks: set[int], chunk_size: int, force: bool = False):
+        now = time.time()
+        # First chunk of a key is saved right away
+        if not force and now - self._saved_at.get(key, 0.0) < self.interval:
+            return
+        self._saved_at[key] = now
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "chunk_size": chunk_size,
+                    "done_chunks": sorted(done_chunks),
+                    "top_losses": top_losses.to_dict(),
+                    "saved": now,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+
+    def remove(self, key: str) -> None:
+        self.get_path(key).unlink(missing_ok=True)
+        self._saved_at.pop(key, None)
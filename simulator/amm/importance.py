@@ -0,0 +1,80 @@
+from math import ceil
+
+import numpy as np
+
+from .price_data import PriceData
+from .sample_plan import SamplePlan
+from .top_losses import TopLosses
+
+
+class VolatilityProposal:
+    """
+    Importance sampling distribution of window starts, proportional to price volatility ahead of the start
+
+    Volatility of a candle is log(high / low), a start is scored by the sum over the next `horizon` candles.
+    Proposal density of start i is mix / L + (1 - mix) * score_i / sum(score), the uniform part bounds
+    importance weights (uniform density / proposal density) by 1 / mix. Weights depend only on the start
+    index, so they are looked up for kept windows after simulation and results stay plain TopLosses.
+    """
+
+    def __init__(self, prices: PriceData, horizon: int, mix: float = 0.1, power: float = 1.0):
+        assert 0 < mix <= 1
+        self.mix = mix
+        candle_volatility = np.log(prices.high / np.maximum(prices.low, 1e-300))
+        cumulative = np.concatenate(([0.0], np.cumsum(candle_volatility)))
+        ends = np.minimum(np.arange(len(prices)) + horizon, len(prices))
+        score = (cumulative[ends] - cumulative[:-1]) ** power
+
+        uniform = np.full(len(prices), 1 / len(prices))
+        if score.sum() > 0:
+            self.density = mix * uniform + (1 - mix) * score / score.sum()
+        else:
+            self.density = uniform
+        self.cdf = np.cumsum(self.density)
+        self.cdf /= self.cdf[-1]
+
+    def weights(self, start_indices: np.ndarray) -> np.ndarray:
+        """
+        Importance weights of windows starting at start_indices, 1 on average over the proposal
+        """
+        start_indices = np.clip(np.asarray(start_indices, dtype=np.int64), 0, len(self.density) - 1)
+        return 1 / (len(self.density) * self.density[start_indices])
+
+    def tail_size(self, samples: int, tail_fraction: float) -> int:
+        """
+        Number of worst windows to keep so that their weights add up to tail_fraction of samples
+
+        Every weight is at least the one of the densest start, so this many windows always cover the tail.
+        """
+        min_weight = 1 / (len(self.density) * self.density.max())
+        return min(ceil(tail_fraction * samples / min_weight) + 1, samples)
+
+    def generate_plan(
+        self, samples: int, min_loan_duration: float, max_loan_duration: float, seed: int | None = None
+    ) -> SamplePlan:
+        """
+        Window starts drawn from the proposal (uniformly inside a candle), durations uniform as in SamplePlan
+        """
+        rng = np.random.default_rng(seed)
+        n = len(self.density)
+        start_indices = np.minimum(np.searchsorted(self.cdf, rng.random(samples), side="right"), n - 1)
+        position_start = (start_indices + rng.random(samples)) / n
+        duration = min_loan_duration + (max_loan_duration - min_loan_duration) * rng.random(samples)
+        return SamplePlan(position_start, duration, seed)
+
+    def tail_mean(self, top_losses: TopLosses, tail_fraction: float) -> float:
+        """
+        Weighted average loss of the worst tail_fraction of windows (CVaR), estimates the same value for uniform
+        windows: consistent as samples grow, but not unbiased for a finite plan
+
+        Windows are taken worst first until their weights add up to tail_fraction of all samples, the last
+        one partially. Windows which were not kept count as zero loss, so top_losses should keep at least
+        tail_size of them.
+        """
+        windows = top_losses.windows()
+        losses = np.array([window["loss"] for window in windows])
+        weights = self.weights([window["start_index"] for window in windows])
+        target = tail_fraction * top_losses.samples
+        before = np.cumsum(weights) - weights
+        taken = np.clip(target - before, 0, weights)
+        return float(taken @ losses / target)
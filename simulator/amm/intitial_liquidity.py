@@ -3,6 +3,11 @@ from typing import Any
 
 
 class BaseRangeInitialLiquidity(ABC):
+    """
+    Deposit of initial liquidity to dn bands at price p0
+
+    Bands should be chosen relative to p0: Simulator deposits once at p0 = 1 and rescales the state to every window.
+    """
 
     def __init__(self, p0: float, dn: int):
         self.p0 = p0
@@ -1,17 +1,98 @@
-from collections import defaultdict
+from array import array
 from math import floor, log, sqrt
 
 
 class LendingAMM:
+    # Bands -BAND_OFFSET..BAND_OFFSET-1 are stored in fixed-size arrays, band n at index n + BAND_OFFSET
+    BAND_OFFSET = 500
+    N_BANDS = 2 * BAND_OFFSET
+
+    __slots__ = (
+        "p_base",
+        "p_oracle",
+        "prev_p_oracle",
+        "A",
+        "dynamic_fee_multiplier",
+        "bands_x",
+        "bands_y",
+        "active_band",
+        "min_band",
+        "max_band",
+        "min_touched_band",
+        "max_touched_band",
+        "_k",
+        "_log_k",
+        "_k_powers",
+        "_sqrt_band_ratio",
+        "_p_oracle_2",
+        "_p_oracle_3",
+        "_fees",
+        "_invariants",
+    )
+
+    # A -> k**n for bands n = -BAND_OFFSET..BAND_OFFSET+1 at index n + BAND_OFFSET, shared by all AMMs with same A.
+    # At most K_POWERS_CACHE_SIZE values of A are kept, the oldest is dropped first
+    _k_powers_by_A: dict[int, array] = {}
+    K_POWERS_CACHE_SIZE = 64
+
     def __init__(self, p_base: float, A: int, dynamic_fee_multiplier: float | None = None):
         self.p_base = p_base
         self.p_oracle = p_base
         self.prev_p_oracle = p_base
         self.A = A
         self.dynamic_fee_multiplier = dynamic_fee_multiplier if dynamic_fee_multiplier is not None else 0.25
-        self.bands_x = defaultdict(float)
-        self.bands_y = defaultdict(float)
+        self.bands_x = array("d", bytes(8 * self.N_BANDS))
+        self.bands_y = array("d", bytes(8 * self.N_BANDS))
         self.active_band = 0
+        # Bands which can have liquidity. Only deposits extend it: trades write to non-empty bands only
+        self.min_touched_band = self.BAND_OFFSET
+        self.max_touched_band = -self.BAND_OFFSET - 1
+
+        self._k = (A - 1) / A  # equal to (p_down / p_up)
+        self._log_k = log(self._k)
+        self._sqrt_band_ratio = sqrt(A / (A - 1))
+        self._k_powers = self._get_k_powers(A)
+        self._set_oracle_factors()
+
+    def copy(self, p_base: float | None = None) -> "LendingAMM":
+        """
+        Independent copy of the state, much cheaper than building an AMM and depositing to it again
+
+        With p_base the copy is moved to another price level, with the oracle reset to p_base as in a new AMM.
+        Only valid before any trades: bands hold only y, which is measured in collateral and doesn't scale.
+        """
+        amm = LendingAMM.__new__(LendingAMM)
+        for name in self.__slots__:
+            setattr(amm, name, getattr(self, name))
+        amm.bands_x = self.bands_x[:]
+        amm.bands_y = self.bands_y[:]
+        amm._fees = {}
+        amm._invariants = {}
+        if p_base is not None:
+            o = self.BAND_OFFSET
+            assert not any(self.bands_x[self.min_touched_band + o : self.max_touched_band + o + 1])
+            amm.p_base = amm.p_oracle = amm.prev_p_oracle = p_base
+            amm._set_oracle_factors()
+        return amm
+
+    @classmethod
+    def _get_k_powers(cls, A) -> array:
+        if A not in cls._k_powers_by_A:
+            if len(cls._k_powers_by_A) >= cls.K_POWERS_CACHE_SIZE:
+                del cls._k_powers_by_A[next(iter(cls._k_powers_by_A))]
+            k = (A - 1) / A
+            cls._k_powers_by_A[A] = array("d", [k**n for n in range(-cls.BAND_OFFSET, cls.BAND_OFFSET + 2)])
+        return cls._k_powers_by_A[A]
+
+    def _band_error(self, n: int) -> IndexError:
+        return IndexError(f"Band {n} is outside of {-self.BAND_OFFSET}..{self.BAND_OFFSET + 1}")
+
+    def _set_oracle_factors(self):
+        # Everything derived from p_oracle only, recalculated once per set_p_oracle
+        self._p_oracle_2 = self.p_oracle**2
+        self._p_oracle_3 = self.p_oracle**3
+        self._fees = {}
+        self._invariants = {}
 
     # Deposit:
     # - above active band - only in y,
@@ -26,52 +107,133 @@ class LendingAMM:
     #  - reduced_input *= (1 - fee), calc output for reduced_input, split fee * input across bands touched
 
     def set_p_oracle(self, p):
+        """
+        p_oracle should only be changed here, so that cached oracle factors stay in sync
+        """
         self.prev_p_oracle = self.p_oracle
         self.p_oracle = p
+        self._set_oracle_factors()
 
     def dynamic_fee(self, n_band):
         """
         Dynamic fee equal to a quarter (by default) of difference between current price and the price of price oracle
         """
+        fees = self._fees
+        if n_band in fees:
+            return fees[n_band]
+
         p_oracle = self.p_oracle
-        p_up = self.p_up(n_band)
+        i = n_band + 1 + self.BAND_OFFSET
+        # Bands above the table raise IndexError by themselves, negative indices would wrap around
+        if i < 0:
+            raise self._band_error(n_band + 1)
+        p_up = self._p_oracle_3 / (self.p_base * self._k_powers[i]) ** 2
 
         if p_oracle > p_up:
-            return ((p_oracle - p_up) / p_oracle) * self.dynamic_fee_multiplier
+            fee = ((p_oracle - p_up) / p_oracle) * self.dynamic_fee_multiplier
         else:
-            return ((p_up - p_oracle) / p_up) * self.dynamic_fee_multiplier
+            fee = ((p_up - p_oracle) / p_up) * self.dynamic_fee_multiplier
+        fees[n_band] = fee
+        return fee
 
     def p_down(self, n_band):
         """
         Lower price for the band at the current p_oracle
         """
-        k = (self.A - 1) / self.A  # equal to (p_down / p_up)
-        p_base = self.p_base * k**n_band
-        return self.p_oracle**3 / p_base**2
+        i = n_band + self.BAND_OFFSET
+        if i < 0:
+            raise self._band_error(n_band)
+        p_base = self.p_base * self._k_powers[i]
+        return self._p_oracle_3 / p_base**2
 
     def p_up(self, n_band):
         """
         Upper price for the band at the current p_oracle
         """
-        k = (self.A - 1) / self.A  # equal to (p_down / p_up)
-        p_base = self.p_base * k ** (n_band + 1)
-        return self.p_oracle**3 / p_base**2
+        i = n_band + 1 + self.BAND_OFFSET
+        if i < 0:
+            raise self._band_error(n_band + 1)
+        p_base = self.p_base * self._k_powers[i]
+        return self._p_oracle_3 / p_base**2
 
     def p_top(self, n):
-        k = (self.A - 1) / self.A  # equal to (p_down / p_up)
         # Prices which show start and end of band when p_oracle = p
-        return self.p_base * k**n
+        i = n + self.BAND_OFFSET
+        if i < 0:
+            raise self._band_error(n)
+        return self.p_base * self._k_powers[i]
 
     def p_bottom(self, n):
-        k = (self.A - 1) / self.A  # equal to (p_down / p_up)
-        return self.p_top(n) * k
+        return self.p_top(n) * self._k
 
     def get_band_n(self, p):
         """
         Rounds correct way for both higher and lower prices
         """
-        k = (self.A - 1) / self.A  # equal to (p_down / p_up)
-        return floor(log(p / self.p_base) / log(k))
+        return floor(log(p / self.p_base) / self._log_k)
+
+    def find_target_price(self, p, is_up=True):
+        """
+        Price to trade to when the external price is p, corrected by the dynamic fee of the target band
+
+        Going up, target band is the highest one in min_band..max_band with p > p_down * (1 + fee),
+        going down - the lowest one with p < p_up * (1 - fee).
+        Both thresholds grow with n when dynamic_fee_multiplier <= 1, so the band is found with binary search.
+        """
+        if self.dynamic_fee_multiplier > 1:
+            return self._find_target_price_linear(p, is_up)
+
+        lo = self.min_band
+        hi = self.max_band
+        if is_up:
+            if not p > self.p_down(lo) * (1 + self.dynamic_fee(lo)):
+                # price is outside of liquidity
+                return p * (1 - self.dynamic_fee(self.min_band))
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if p > self.p_down(mid) * (1 + self.dynamic_fee(mid)):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            return p * (1 - self.dynamic_fee(lo))
+
+        else:
+            if not p < self.p_up(hi) * (1 - self.dynamic_fee(hi)):
+                # price is outside of liquidity
+                return p * (1 + self.dynamic_fee(self.max_band))
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if p < self.p_up(mid) * (1 - self.dynamic_fee(mid)):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return p * (1 + self.dynamic_fee(lo))
+
+    def _find_target_price_linear(self, p, is_up=True):
+        # Find target band
+        if is_up:
+            for n in range(self.max_band, self.min_band - 1, -1):
+                p_down = self.p_down(n)
+                d_fee = self.dynamic_fee(n)
+                p_down_with_fee = p_down * (1 + d_fee)
+
+                if p > p_down_with_fee:
+                    return p * (1 - d_fee)
+
+        else:
+            for n in range(self.min_band, self.max_band + 1):
+                p_up = self.p_up(n)
+                d_fee = self.dynamic_fee(n)
+                p_up_ = p_up * (1 - d_fee)
+
+                if p < p_up_:
+                    return p * (1 + d_fee)
+
+        # price is outside of liquidity
+        if is_up:
+            return p * (1 - self.dynamic_fee(self.min_band))
+        else:
+            return p * (1 + self.dynamic_fee(self.max_band))
 
     def deposit_range(self, amount, p1, p2):
         assert p1 <= self.p_oracle and p2 <= self.p_oracle
@@ -81,9 +243,7 @@ class LendingAMM:
         y = amount / (n2 - n1 + 1)
         self.min_band = min(n1, n2)
         self.max_band = max(n1, n2)
-        for i in range(n1, n2 + 1):
-            assert self.bands_x[i] == 0
-            self.bands_y[i] += y
+        self._deposit_bands(n1, n2, y)
 
     def deposit_nrange(self, amount, p, dn):
         n_top = self.get_band_n(self.p_oracle) + 1
@@ -93,23 +253,31 @@ class LendingAMM:
         y = amount / dn
         self.min_band = n1
         self.max_band = n2
+        self._deposit_bands(n1, n2, y)
+
+    def _deposit_bands(self, n1, n2, y):
+        assert -self.BAND_OFFSET < n1 and n2 < self.BAND_OFFSET, "bands should not exceed 500"
+        o = self.BAND_OFFSET
         for i in range(n1, n2 + 1):
-            assert self.bands_x[i] == 0
-            self.bands_y[i] += y
+            assert self.bands_x[i + o] == 0
+            self.bands_y[i + o] += y
+        self._invariants.clear()
+        self.min_touched_band = min(self.min_touched_band, n1)
+        self.max_touched_band = max(self.max_touched_band, n2)
 
     def get_y0(self, n=None):
         A = self.A
         if n is None:
             n = self.active_band
-        x = self.bands_x[n]
-        y = self.bands_y[n]
+        x = self.bands_x[n + self.BAND_OFFSET]
+        y = self.bands_y[n + self.BAND_OFFSET]
         p_o = self.p_oracle
         p_top = self.p_top(n)
 
         # solve:
         # p_o * A * y0**2 - y0 * (p_top/p_o * (A-1) * x + p_o**2/p_top * A * y) - xy = 0
         a = p_o * A
-        b = p_top / p_o * (A - 1) * x + p_o**2 / p_top * A * y
+        b = p_top / p_o * (A - 1) * x + self._p_oracle_2 / p_top * A * y
         D = b**2 + 4 * a * x * y
         return (b + sqrt(D)) / (2 * a)
 
@@ -119,8 +287,7 @@ class LendingAMM:
         if n is None:
             n = self.active_band
         p_top = self.p_top(n)
-        p_oracle = self.p_oracle
-        return y0 * p_oracle**2 / p_top * self.A
+        return y0 * self._p_oracle_2 / p_top * self.A
 
     def get_g(self, y0=None, n=None):
         if y0 is None:
@@ -131,13 +298,24 @@ class LendingAMM:
         p_oracle = self.p_oracle
         return y0 * p_top / p_oracle * (self.A - 1)
 
+    def get_invariants(self, n):
+        """
+        (y0, f, g) of the band n, cached until reserves of the band or p_oracle change
+        """
+        invariants = self._invariants.get(n)
+        if invariants is None:
+            y0 = self.get_y0(n)
+            invariants = self._invariants[n] = (y0, self.get_f(y0, n), self.get_g(y0, n))
+        return invariants
+
     def get_p(self, y0=None):
-        x = self.bands_x[self.active_band]
-        y = self.bands_y[self.active_band]
+        x = self.bands_x[self.active_band + self.BAND_OFFSET]
+        y = self.bands_y[self.active_band + self.BAND_OFFSET]
         if x == 0 and y == 0:
             return (self.p_up(self.active_band) * self.p_down(self.active_band)) ** 0.5
         if y0 is None:
-            y0 = self.get_y0()
+            _, f, g = self.get_invariants(self.active_band)
+            return (f + x) / (g + y)
         return (self.get_f(y0) + x) / (self.get_g(y0) + y)
 
     def trade_to_price(self, price) -> tuple:
@@ -146,7 +324,11 @@ class LendingAMM:
         Returns tuple of x and y changes in target band
         """
 
-        if self.bands_x[self.active_band] == 0 and self.bands_y[self.active_band] == 0:
+        bands_x = self.bands_x
+        bands_y = self.bands_y
+        o = self.BAND_OFFSET
+
+        if bands_x[self.active_band + o] == 0 and bands_y[self.active_band + o] == 0:
             # If current band is empty - steps are determined by whether current price is higher or lower than
             # boundaries
             if price > self.p_up(self.active_band):
@@ -174,8 +356,8 @@ class LendingAMM:
             n = self.active_band
             assert -500 < n < 500, "active band should not exceed 500"
 
-            x = self.bands_x[n]
-            y = self.bands_y[n]
+            x = bands_x[n + o]
+            y = bands_y[n + o]
 
             if x == 0 and y == 0:
                 if self.p_down(n) <= price <= self.p_up(n):
@@ -183,9 +365,9 @@ class LendingAMM:
                 self.active_band += bstep
                 continue
 
-            y0 = self.get_y0()
-            g = self.get_g(y0)
-            f = self.get_f(y0)
+            y0, f, g = self.get_invariants(n)
+            # Reserves of the band change below
+            del self._invariants[n]
             # (f + x)(g + y) = const = p_oracle * A**2 * y0**2 = I
             Inv = (f + x) * (g + y)
             # p = (f + x) / (g + y) => p * (g + y)**2 = I or (f + x)**2 / p = I
@@ -202,22 +384,22 @@ class LendingAMM:
 
                 # reduce y, increase x, go up
                 y_dest = (Inv / price) ** 0.5 - g
-                x_old = self.bands_x[n]
+                x_old = bands_x[n + o]
                 if y_dest >= 0:
                     # End the cycle
-                    self.bands_y[n] = y_dest
-                    self.bands_x[n] = Inv / (g + y_dest) - f
-                    delta_x = self.bands_x[n] - x_old
-                    self.bands_x[n] += fee * delta_x
-                    dx += self.bands_x[n] - x
-                    dy += self.bands_y[n] - y
+                    bands_y[n + o] = y_dest
+                    bands_x[n + o] = Inv / (g + y_dest) - f
+                    delta_x = bands_x[n + o] - x_old
+                    bands_x[n + o] += fee * delta_x
+                    dx += bands_x[n + o] - x
+                    dy += bands_y[n + o] - y
                     break
 
                 else:
-                    self.bands_y[n] = 0
-                    self.bands_x[n] = Inv / g - f
-                    delta_x = self.bands_x[n] - x_old
-                    self.bands_x[n] += fee * delta_x
+                    bands_y[n + o] = 0
+                    bands_x[n + o] = Inv / g - f
+                    delta_x = bands_x[n + o] - x_old
+                    bands_x[n + o] += fee * delta_x
                     self.active_band += 1
 
             else:  # down
@@ -227,26 +409,26 @@ class LendingAMM:
 
                 # increase y, reduce x, go down
                 x_dest = (Inv * price) ** 0.5 - f
-                y_old = self.bands_y[n]
+                y_old = bands_y[n + o]
                 if x_dest >= 0:
                     # End the cycle
-                    self.bands_x[n] = x_dest
-                    self.bands_y[n] = Inv / (f + x_dest) - g
-                    delta_y = self.bands_y[n] - y_old
-                    self.bands_y[n] += fee * delta_y
-                    dx += self.bands_x[n] - x
-                    dy += self.bands_y[n] - y
+                    bands_x[n + o] = x_dest
+                    bands_y[n + o] = Inv / (f + x_dest) - g
+                    delta_y = bands_y[n + o] - y_old
+                    bands_y[n + o] += fee * delta_y
+                    dx += bands_x[n + o] - x
+                    dy += bands_y[n + o] - y
                     break
 
                 else:
-                    self.bands_x[n] = 0
-                    self.bands_y[n] = Inv / f - g
-                    delta_y = self.bands_y[n] - y_old
-                    self.bands_y[n] += fee * delta_y
+                    bands_x[n + o] = 0
+                    bands_y[n + o] = Inv / f - g
+                    delta_y = bands_y[n + o] - y_old
+                    bands_y[n + o] += fee * delta_y
                     self.active_band -= 1
 
-            dx += self.bands_x[n] - x
-            dy += self.bands_y[n] - y
+            dx += bands_x[n + o] - x
+            dy += bands_y[n + o] - y
 
         return dx, dy
 
@@ -254,13 +436,13 @@ class LendingAMM:
         """
         Measure the amount of y in the band n if we adiabatically trade near p_oracle on the way up
         """
-        x = self.bands_x[n]
-        y = self.bands_y[n]
+        x = self.bands_x[n + self.BAND_OFFSET]
+        y = self.bands_y[n + self.BAND_OFFSET]
         p_o = self.p_oracle
         p_o_up = self.p_top(n)
         p_o_down = p_o_up * (self.A - 1) / self.A
         p_current_mid = p_o**3 / p_o_down**2 * (self.A - 1) / self.A
-        sqrt_band_ratio = sqrt(self.A / (self.A - 1))
+        sqrt_band_ratio = self._sqrt_band_ratio
 
         if x == 0 or y == 0:
             if x == 0 and y == 0:
@@ -279,9 +461,7 @@ class LendingAMM:
                     x_equiv = y * p_current_mid
                 return x_equiv * sqrt_band_ratio / p_o_up
 
-        y0 = self.get_y0(n)
-        g = self.get_g(y0, n)
-        f = self.get_f(y0, n)
+        y0, f, g = self.get_invariants(n)
         # (f + x)(g + y) = const = p_top * A**2 * y0**2 = I
         Inv = (f + x) * (g + y)
         # p = (f + x) / (g + y) => p * (g + y)**2 = I or (f + x)**2 / p = I
@@ -314,13 +494,13 @@ class LendingAMM:
         """
         Measure the amount of x in the band n if we adiabatically trade near p_oracle on the way up
         """
-        x = self.bands_x[n]
-        y = self.bands_y[n]
+        x = self.bands_x[n + self.BAND_OFFSET]
+        y = self.bands_y[n + self.BAND_OFFSET]
         p_o = self.p_oracle
         p_o_up = self.p_top(n)
         p_o_down = p_o_up * (self.A - 1) / self.A
         p_current_mid = p_o**3 / p_o_down**2 * (self.A - 1) / self.A
-        sqrt_band_ratio = sqrt(self.A / (self.A - 1))
+        sqrt_band_ratio = self._sqrt_band_ratio
 
         if x == 0 or y == 0:
             if x == 0 and y == 0:
@@ -339,9 +519,7 @@ class LendingAMM:
                     x_equiv = y * p_current_mid
                 return x_equiv
 
-        y0 = self.get_y0(n)
-        g = self.get_g(y0, n)
-        f = self.get_f(y0, n)
+        y0, f, g = self.get_invariants(n)
         # (f + x)(g + y) = const = p_top * A**2 * y0**2 = I
         Inv = (f + x) * (g + y)
         # p = (f + x) / (g + y) => p * (g + y)**2 = I or (f + x)**2 / p = I
@@ -370,7 +548,13 @@ class LendingAMM:
             return x_o + y_o * sqrt(p_o_down * p_o)
 
     def get_all_y(self):
-        return sum(self.get_y_up(i) for i in range(-500, 500))
+        return sum(self.get_y_up(i) for i in range(self.min_touched_band, self.max_touched_band + 1))
 
     def get_all_x(self):
-        return sum(self.get_x_down(i) for i in range(-500, 500))
+        return sum(self.get_x_down(i) for i in range(self.min_touched_band, self.max_touched_band + 1))
+
+    def get_bands_x(self):
+        """
+        get_x_down of every band which can have liquidity, get_all_x is their sum
+        """
+        return [self.get_x_down(i) for i in range(self.min_touched_band, self.max_touched_band + 1)]
@@ -0,0 +1,75 @@
+import hashlib
+from typing import Iterator
+
+import numpy as np
+
+
+class PriceData:
+    """
+    Columnar price history: timestamp, OHLC, vol stored as contiguous numpy arrays
+
+    Mimics the list of [t, open, high, low, close, vol] rows returned by the list loaders:
+    len(), row access by index, iteration over rows and slicing. Slices are views, so taking a
+    simulation window does not copy anything.
+    """
+
+    columns = ("t", "open", "high", "low", "close", "vol")
+    __slots__ = columns + ("_digest",)
+
+    def __init__(
+        self,
+        t: np.ndarray,
+        open: np.ndarray,
+        high: np.ndarray,
+        low: np.ndarray,
+        close: np.ndarray,
+        vol: np.ndarray,
+    ):
+        self.t = np.asarray(t, dtype=np.int64)
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.vol = np.asarray(vol, dtype=np.float64)
+        self._digest: str | None = None
+
+    @classmethod
+    def from_rows(cls, rows: list) -> "PriceData":
+        """
+        Build from rows of [t, open, high, low, close, vol, ...] (extra columns are ignored)
+        """
+        data = np.asarray(rows, dtype=np.float64).reshape(len(rows), -1)
+        return cls(data[:, 0].astype(np.int64), *(np.ascontiguousarray(data[:, i]) for i in range(1, 6)))
+
+    def arrays(self) -> tuple[np.ndarray, ...]:
+        return tuple(getattr(self, c) for c in self.columns)
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return PriceData(*(c[item] for c in self.arrays()))
+        return tuple(c[item].item() for c in self.arrays())
+
+    def __iter__(self) -> Iterator[tuple]:
+        # tolist() converts to python scalars at once, which are much faster to do arithmetic with
+        return zip(*(c.tolist() for c in self.arrays()))
+
+    def to_rows(self) -> list:
+        return [list(row) for row in self]
+
+    def digest(self) -> str:
+        """
+        Content hash of all columns, used as a key for caches derived from the dataset
+        """
+        if self._digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            for c in self.arrays():
+                h.update(np.ascontiguousarray(c).data)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    @property
+    def nbytes(self) -> int:
+        return sum(c.nbytes for c in self.arrays())
@@ -1,9 +1,15 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
 from enum import StrEnum
 
+import numpy as np
+
 from simulator.import_data.binance import BinanceImporter
+from simulator.import_data.cache import load_derived_arrays
 from simulator.settings import Pair
 
+from .price_data import PriceData
+
 
 class ImporterType(StrEnum):
     binance = "binance"
@@ -11,11 +17,36 @@ class ImporterType(StrEnum):
 
 class BasePriceHistoryLoader(ABC):
     @abstractmethod
-    def load_prices(self) -> list: ...
+    def load_prices(self) -> list | PriceData: ...
+
+
+class ArrayPriceHistoryLoader(BasePriceHistoryLoader):
+    """
+    Prices which are already loaded, e.g. attached from shared memory in worker processes
+    """
+
+    def __init__(self, prices: PriceData):
+        self.prices = prices
+
+    def load_prices(self) -> PriceData:
+        return self.prices
 
 
 class GenericPriceHistoryLoader(BasePriceHistoryLoader):
-    def __init__(self, pair: Pair, importer_type: ImporterType = ImporterType.binance, add_reverse: bool = True):
+    def __init__(
+        self,
+        pair: Pair,
+        importer_type: ImporterType = ImporterType.binance,
+        add_reverse: bool = True,
+        columnar: bool = False,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ):
+        """
+        :param columnar: return PriceData (numpy columns) instead of a list of rows
+        :param start: load only prices from this time (with end - only partitions of the dataset in the range)
+        :param end: load only prices before this time
+        """
         if importer_type == ImporterType.binance:
             self.importer = BinanceImporter()
         else:
@@ -23,9 +54,19 @@ class GenericPriceHistoryLoader(BasePriceHistoryLoader):
 
         self.pair = pair
         self.add_reverse = add_reverse
+        self.columnar = columnar
+        self.start_ts = int(start.timestamp()) if start is not None else None
+        self.end_ts = int(end.timestamp()) if end is not None else None
+
+    def load_prices(self) -> list | PriceData:
+        if self.columnar:
+            return self.load_price_data()
 
-    def load_prices(self) -> list:
-        data = self.importer.load(self.pair)
+        if self.start_ts is None and self.end_ts is None:
+            data = self.importer.load(self.pair)
+        else:
+            # Only partitions which overlap the range are read
+            data = self.importer.load_columns(self.pair, self.start_ts, self.end_ts)[:6].T.tolist()
 
         # timestamp, OHLC, vol
         unfiltered_data = [[int(d[0])] + [float(x) for x in d[1:6]] for d in data]
@@ -40,3 +81,40 @@ class GenericPriceHistoryLoader(BasePriceHistoryLoader):
             data += [[t0 + (t0 - d[0])] + d[1:] for d in data[::-1]]
 
         return data
+
+    def load_price_data(self) -> PriceData:
+        """
+        Filtered (and reversed) prices are cached as memory-mapped binary files next to the data, so that
+        processes loading the same prices share their pages in the OS page cache
+        """
+        fingerprint = self.importer.get_fingerprint(self.pair)
+        start_ts, end_ts = self.importer.get_time_range(self.start_ts, self.end_ts)
+        if fingerprint["last_t"] is not None:
+            # Importer end is usually "now", only the data in the range matters
+            end_ts = min(end_ts, fingerprint["last_t"] + 1)
+        arrays = load_derived_arrays(
+            self.importer.get_data_path(self.pair),
+            fingerprint,
+            {"start_ts": start_ts, "end_ts": end_ts, "add_reverse": self.add_reverse},
+            self._build_price_data,
+        )
+        return PriceData(*(arrays[c] for c in PriceData.columns))
+
+    def _build_price_data(self) -> dict[str, np.ndarray]:
+        # Memory-mapped binary cache of the imported data, see BaseImporter.load_columns
+        data = PriceData(*self.importer.load_columns(self.pair, self.start_ts, self.end_ts)[:6])
+
+        # Same filter as for the list: drop rows which go back in time
+        t = data.t
+        mask = t == np.maximum.accumulate(t)
+        if not mask.all():
+            data = PriceData(*(c[mask] for c in data.arrays()))
+
+        if self.add_reverse:
+            t0 = data.t[-1]
+            data = PriceData(
+                np.concatenate([data.t, t0 + (t0 - data.t[::-1])]),
+                *(np.concatenate([c, c[::-1]]) for c in data.arrays()[1:]),
+            )
+
+        return dict(zip(PriceData.columns, data.arrays()))
@@ -1,27 +1,151 @@
+import os
 from abc import ABC, abstractmethod
 
+import numpy as np
+
+from simulator.settings import CACHE_DIR
+
+from .price_data import PriceData
+
+# Max exponent of 2 accumulated inside one block of ema_oracle_prices, keeps weights far from float overflow
+EMA_BLOCK_EXPONENT = 768.0
+
 
 class BasePriceOracle(ABC):
     @abstractmethod
-    def calculate_oracle_prices(self, price_data: list): ...
+    def calculate_oracle_prices(self, price_data: list | PriceData): ...
+
+
+class PrecomputedPriceOracle(BasePriceOracle):
+    """
+    Oracle prices which are already calculated for the price data, e.g. attached from shared memory
+    """
+
+    def __init__(self, oracle_prices: list | np.ndarray):
+        self.oracle_prices = oracle_prices
+
+    def calculate_oracle_prices(self, price_data: list | PriceData) -> list | np.ndarray:
+        assert len(self.oracle_prices) == len(price_data)
+        return self.oracle_prices
 
 
 class EmaPriceOracle(BasePriceOracle):
-    def __init__(self, t_exp: int):
+    # (dataset digest, t_exp) -> oracle prices, shared by all oracles of the process
+    _memory_cache: dict[tuple[str, int], np.ndarray] = {}
+
+    def __init__(self, t_exp: int, use_cache: bool = True):
+        """
+        :param t_exp: EMA time constant in seconds
+        :param use_cache: memoize PriceData results in memory and in CACHE_DIR / "oracle"
+        """
         self.t_exp = t_exp  # in seconds
+        self.use_cache = use_cache
 
-    def calculate_oracle_prices(self, price_data: list) -> list:
+    def calculate_oracle_prices(self, price_data: list | PriceData) -> list | np.ndarray:
         """
         Important: price data time is in seconds
+
+        Returns numpy array for PriceData input and list otherwise
+        """
+        if isinstance(price_data, PriceData):
+            return self.calculate_oracle_prices_multi(price_data, [self.t_exp], use_cache=self.use_cache)[0]
+
+        return self._calculate_ema(price_data[0][1], [d[0] for d in price_data], [d[4] for d in price_data])
+
+    @classmethod
+    def calculate_oracle_prices_multi(
+        cls, price_data: PriceData, t_exps: list[int], use_cache: bool = True
+    ) -> np.ndarray:
         """
+        Oracle prices for several t_exp at once: array of shape (len(t_exps), len(price_data))
+
+        Values which are not cached yet are calculated in one pass over the data
+        """
+        result = np.empty((len(t_exps), len(price_data)))
+        missing = []
+        for i, t_exp in enumerate(t_exps):
+            cached = cls._load_cached(price_data, t_exp) if use_cache else None
+            if cached is None:
+                missing.append(i)
+            else:
+                result[i] = cached
+
+        if missing:
+            missing_t_exps = [t_exps[i] for i in missing]
+            result[missing] = ema_oracle_prices(
+                price_data.t, price_data.close, price_data.open[0].item(), missing_t_exps
+            )
+            if use_cache:
+                for i, t_exp in zip(missing, missing_t_exps):
+                    cls._save_cached(price_data, t_exp, result[i])
+
+        return result
+
+    @classmethod
+    def get_cache_path(cls, price_data: PriceData, t_exp: int):
+        return CACHE_DIR / "oracle" / f"ema_{price_data.digest()}_{t_exp}.npy"
+
+    @classmethod
+    def _load_cached(cls, price_data: PriceData, t_exp: int) -> np.ndarray | None:
+        key = (price_data.digest(), t_exp)
+        if key not in cls._memory_cache:
+            path = cls.get_cache_path(price_data, t_exp)
+            if not path.exists():
+                return None
+            cls._memory_cache[key] = np.load(path, mmap_mode="r")
+        return cls._memory_cache[key]
+
+    @classmethod
+    def _save_cached(cls, price_data: PriceData, t_exp: int, oracle_prices: np.ndarray) -> None:
+        path = cls.get_cache_path(price_data, t_exp)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, oracle_prices)
+        os.replace(tmp_path, path)
+        cls._memory_cache[(price_data.digest(), t_exp)] = np.load(path, mmap_mode="r")
+
+    def _calculate_ema(self, ema: float, times: list, closes: list) -> list:
         data = []
 
-        ema = price_data[0][1]
-        ema_t = price_data[0][0]
-        for t, _, _, _, close, _ in price_data:
+        ema_t = times[0]
+        for t, close in zip(times, closes):
             ema_mul = 2 ** (-(t - ema_t) / self.t_exp)
             ema = ema * ema_mul + close * (1 - ema_mul)
             ema_t = t
             data.append(ema)
 
         return data
+
+
+def ema_oracle_prices(t: np.ndarray, close: np.ndarray, ema0: float, t_exps: list[int]) -> np.ndarray:
+    """
+    Vectorized EmaPriceOracle for sorted timestamps, returns array of shape (len(t_exps), len(t))
+
+    Unrolls ema_i = ema_{i-1} * m_i + close_i * (1 - m_i), m_i = 2 ** (-(t_i - t_{i-1}) / t_exp) inside blocks
+    starting at index s:
+        ema_i = 2 ** -b_i * (ema_{s-1} * m_s + sum_{s<=j<=i} close_j * (1 - m_j) * 2 ** b_j), b_i = (t_i - t_s) / t_exp
+    Blocks are cut so that b stays below EMA_BLOCK_EXPONENT. Equal to the loop up to float rounding.
+    """
+    t = np.asarray(t, dtype=np.int64)
+    close = np.asarray(close, dtype=np.float64)
+    t_exps = np.asarray(t_exps, dtype=np.float64)[:, None]
+    if np.any(t[1:] < t[:-1]):
+        raise ValueError("Timestamps should be sorted")
+
+    result = np.empty((len(t_exps), len(t)))
+    dt = np.diff(t, prepend=t[:1])
+
+    span = EMA_BLOCK_EXPONENT * t_exps.min()
+    ema = np.full(len(t_exps), ema0)
+    s = 0
+    while s < len(t):
+        e = max(int(np.searchsorted(t, t[s] + span, side="right")), s + 1)
+        mul = np.exp2(-dt[s:e] / t_exps)
+        weights = np.exp2((t[s:e] - t[s]) / t_exps)
+        acc = np.cumsum(close[s:e] * (1 - mul) * weights, axis=1)
+        result[:, s:e] = (ema[:, None] * mul[:, :1] + acc) / weights
+        ema = result[:, e - 1]
+        s = e
+
+    return result
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class RangeExtrema:
+    """
+    Range max (or min) of an array over many windows [start, end) at once, O(1) per window
+
+    Values are split into blocks of `block_size`: windows crossing a block boundary are answered exactly from
+    in-block suffix / prefix extrema and a sparse table over block extrema. Windows inside one block get the
+    extremum of the whole block, which is never smaller (larger for min) than the exact one.
+    Memory is O(n), unlike a full sparse table with log(n) arrays of size n.
+    """
+
+    def __init__(self, values: np.ndarray, is_max: bool = True, block_size: int = 16):
+        self.ufunc = np.maximum if is_max else np.minimum
+        self.builtin = max if is_max else min
+        self.block_size = block_size
+        self.size = len(values)
+
+        n_blocks = -(-self.size // block_size)
+        fill = -np.inf if is_max else np.inf
+        blocks = np.full(n_blocks * block_size, fill)
+        blocks[: self.size] = values
+        blocks = blocks.reshape(n_blocks, block_size)
+
+        self.prefix = self.ufunc.accumulate(blocks, axis=1).ravel()
+        self.suffix = self.ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+        # table[k][i] - extremum of blocks i..i + 2**k - 1
+        self.table = [self.ufunc.reduce(blocks, axis=1)]
+        while 2 ** len(self.table) <= n_blocks:
+            previous = self.table[-1]
+            half = 2 ** (len(self.table) - 1)
+            self.table.append(self.ufunc(previous[:-half], previous[half:]))
+
+    def _blocks_query(self, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+        # Extremum of blocks lo..hi - 1, hi > lo
+        level = np.log2(hi - lo).astype(np.int64)
+        result = np.empty(len(lo))
+        for k in np.unique(level).tolist():
+            mask = level == k
+            result[mask] = self.ufunc(self.table[k][lo[mask]], self.table[k][hi[mask] - 2**k])
+        return result
+
+    def query(self, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """
+        Extremum of values[start:end] for every pair, windows should not be empty
+        """
+        start = np.asarray(start, dtype=np.int64)
+        last = np.minimum(np.asarray(end, dtype=np.int64), self.size) - 1
+        assert np.all(last >= start), "empty window"
+        start_block = start // self.block_size
+        last_block = last // self.block_size
+
+        result = self.ufunc(self.suffix[start], self.prefix[last])
+        inner = last_block - start_block > 1
+        if inner.any():
+            result[inner] = self.ufunc(result[inner], self._blocks_query(start_block[inner] + 1, last_block[inner]))
+        same = start_block == last_block
+        result[same] = self.table[0][start_block[same]]
+        return result
+
+    def query_one(self, start: int, end: int) -> float:
+        """
+        Same as query for a single window, without the overhead of numpy calls on tiny arrays
+        """
+        last = min(end, self.size) - 1
+        assert last >= start, "empty window"
+        start_block = start // self.block_size
+        last_block = last // self.block_size
+        if start_block == last_block:
+            return float(self.table[0][start_block])
+
+        result = self.builtin(float(self.suffix[start]), float(self.prefix[last]))
+        if last_block - start_block > 1:
+            lo = start_block + 1
+            k = (last_block - lo).bit_length() - 1
+            result = self.builtin(result, float(self.table[k][lo]), float(self.table[k][last_block - 2**k]))
+        return result
+
+
+class QuietWindowIndex:
+    """
+    Tells whether windows of price history can bring the price to the deposited bands
+
+    Liquidity is deposited in bands above the active one, so trades reach it only from below: band n is touched
+    only when the external price corrected by fees is higher than p_down(n) = p_oracle**3 / p_top(n)**2.
+    If max(high) * (1 - external_fee) * p_top(n1)**2 < min(p_oracle)**3 over the window, AMM reserves stay
+    untouched and the loss depends only on the last oracle price.
+    """
+
+    # Relative margin for float rounding of thresholds calculated per candle, only reduces the number of skips
+    margin = 1e-9
+
+    def __init__(self, high: np.ndarray, oracle_prices: np.ndarray, external_fee: float = 0.0):
+        self.high = RangeExtrema(high, is_max=True)
+        self.oracle = RangeExtrema(oracle_prices, is_max=False)
+        self.external_fee = external_fee
+
+    def is_quiet(self, start: np.ndarray, end: np.ndarray, p_top: np.ndarray) -> np.ndarray:
+        """
+        :param start: first candle of every window
+        :param end: end of every window (exclusive)
+        :param p_top: p_top(min_band) - of the first band with liquidity for every window
+        """
+        max_high = self.high.query(start, end) * (1 - self.external_fee)
+        min_oracle = self.oracle.query(start, end)
+        return max_high * np.asarray(p_top) ** 2 * (1 + self.margin) < min_oracle**3
+
+    def is_quiet_one(self, start: int, end: int, p_top: float) -> bool:
+        max_high = self.high.query_one(start, end) * (1 - self.external_fee)
+        min_oracle = self.oracle.query_one(start, end)
+        return max_high * p_top**2 * (1 + self.margin) < min_oracle**3
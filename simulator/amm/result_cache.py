@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from simulator.settings import RESULT_CACHE_DIR, RESULT_CACHE_MAX_SIZE
+
+from .top_losses import TopLosses
+
+logger = logging.getLogger(__name__)
+
+# Bump when simulation changes results, old entries are never hit again and get evicted
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    Top losses of finished simulations on disk, one json file per result
+
+    Keys are content hashes of everything the result depends on: prices, oracle prices, initial liquidity,
+    external fee, AMM parameters and the sample plan (which covers sample count, loan durations and seed).
+    Least recently used entries are removed when the total size exceeds max_size.
+    """
+
+    def __init__(self, path: Path = RESULT_CACHE_DIR, max_size: int = RESULT_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(params: dict) -> str:
+        """
+        :param params: json serializable description of the simulation, including content digests of its inputs
+        """
+        data = json.dumps({"version": RESULT_CACHE_VERSION, **params}, sort_keys=True)
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def get_entry_path(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def load(self, key: str) -> TopLosses | None:
+        path = self.get_entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Modification time is the last use time for LRU
+        os.utime(path)
+        logger.info(f"Loaded cached result {key}.")
+        return TopLosses.from_dict(entry["top_losses"])
+
+    def save(self, key: str, top_losses: TopLosses, params: dict) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.get_entry_path(key)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"params": params, "created": time.time(), "top_losses": top_losses.to_dict()}, f)
+        os.replace(tmp_path, path)
+        self.prune(self.max_size)
+
+    def entries(self) -> list[tuple[Path, os.stat_result]]:
+        """
+        Entry files with their stats, least recently used first
+        """
+        if not self.path.exists():
+            return []
+        entries = [(path, path.stat()) for path in self.path.glob("*.json")]
+        return sorted(entries, key=lambda entry: entry[1].st_mtime)
+
+    def info(self) -> dict:
+        entries = self.entries()
+        return {
+            "path": str(self.path),
+            "entries": len(entries),
+            "size": sum(stat.st_size for _, stat in entries),
+            "max_size": self.max_size,
+            "least_recently_used": entries[0][1].st_mtime if entries else None,
+            "most_recently_used": entries[-1][1].st_mtime if entries else None,
+        }
+
+    def prune(self, max_size: int | None = None, max_age: float | None = None) -> int:
+        """
+        Remove entries unused for more than max_age seconds, then least recently used ones above max_size bytes
+
+        Returns number of removed entries
+        """
+        entries = self.entries()
+        size = sum(stat.st_size for _, stat in entries)
+        now = time.time()
+        removed = 0
+        for path, stat in entries:
+            expired = max_age is not None and now - stat.st_mtime > max_age
+            if not expired and (max_size is None or size <= max_size):
+                continue
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+            removed += 1
+        return removed
@@ -0,0 +1,70 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+
+class SamplePlan:
+    """
+    Simulation windows drawn once and reused for every parameter value of a sweep (common random numbers)
+
+    Windows are stored independently of the dataset: start as a fraction of price history and duration in days,
+    so the same plan gives the same windows for every Simulator which loaded the same prices.
+    """
+
+    def __init__(self, position_start: np.ndarray, duration: np.ndarray, seed: int | None = None):
+        self.position_start = np.asarray(position_start, dtype=np.float64)
+        self.duration = np.asarray(duration, dtype=np.float64)  # days
+        self.seed = seed
+        assert self.position_start.shape == self.duration.shape
+
+    @classmethod
+    def generate(
+        cls, samples: int, min_loan_duration: float, max_loan_duration: float, seed: int | None = None
+    ) -> "SamplePlan":
+        """
+        Uniform window starts and durations in [min_loan_duration, max_loan_duration) days
+        """
+        rng = np.random.default_rng(seed)
+        position_start = rng.random(samples)
+        duration = min_loan_duration + (max_loan_duration - min_loan_duration) * rng.random(samples)
+        return cls(position_start, duration, seed)
+
+    def __len__(self) -> int:
+        return len(self.position_start)
+
+    def __getitem__(self, item: slice) -> "SamplePlan":
+        return SamplePlan(self.position_start[item], self.duration[item], self.seed)
+
+    def digest(self) -> str:
+        """
+        Content hash of the windows, used as a part of result cache keys
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(self.position_start).data)
+        h.update(np.ascontiguousarray(self.duration).data)
+        return h.hexdigest()
+
+    def positions(self, day_fraction: float) -> list[tuple[float, float]]:
+        """
+        (position_start, position_period) pairs as accepted by Simulator.single_run
+
+        :param day_fraction: which fraction of all price data is 1 day
+        """
+        return list(zip(self.position_start.tolist(), (self.duration * day_fraction).tolist()))
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                position_start=self.position_start,
+                duration=self.duration,
+                seed=np.array(-1 if self.seed is None else self.seed),
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> "SamplePlan":
+        with np.load(path) as data:
+            seed = int(data["seed"])
+            return cls(data["position_start"], data["duration"], None if seed < 0 else seed)
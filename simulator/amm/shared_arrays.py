@@ -0,0 +1,54 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# name -> (shared memory block name, shape, dtype)
+SharedArraySpecs = dict[str, tuple[str, tuple[int, ...], str]]
+
+
+class SharedArrays:
+    """
+    Numpy arrays copied once into multiprocessing.shared_memory blocks
+
+    Owner process creates it (and must close it), workers attach by specs without copying.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.blocks: list[SharedMemory] = []
+        self.specs: SharedArraySpecs = {}
+        try:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                block = SharedMemory(create=True, size=max(array.nbytes, 1))
+                self.blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                self.specs[name] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    def attach(specs: SharedArraySpecs) -> tuple[dict[str, np.ndarray], list[SharedMemory]]:
+        """
+        Map arrays created in another process. Returned blocks should be kept alive while arrays are used
+        """
+        arrays = {}
+        blocks = []
+        for name, (block_name, shape, dtype) in specs.items():
+            # Workers share the owner's resource tracker, so attaching here doesn't register a second owner
+            block = SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        return arrays, blocks
+
+    def close(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,17 +1,41 @@
+import hashlib
 import logging
-import random
-from concurrent.futures import ProcessPoolExecutor
+import os
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from enum import StrEnum
 
-from .intitial_liquidity import BaseRangeInitialLiquidity
+import numpy as np
+
+from .band_decomposition import check_validated, get_range_losses
+from .batch import run_batch, run_batch_ranges
+from .importance import VolatilityProposal
+from .intitial_liquidity import BaseRangeInitialLiquidity, ConstantInitialLiquidity
 from .lending_amm import LendingAMM
-from .price_history_loader import BasePriceHistoryLoader
-from .price_oracle import BasePriceOracle
+from .price_data import PriceData
+from .price_history_loader import ArrayPriceHistoryLoader, BasePriceHistoryLoader
+from .price_oracle import BasePriceOracle, PrecomputedPriceOracle
+from .range_index import QuietWindowIndex
+from .result_cache import ResultCache
+from .sample_plan import SamplePlan
+from .shared_arrays import SharedArrays, SharedArraySpecs
+from .top_losses import TopLosses
 
 logger = logging.getLogger(__name__)
 
 
+class SimulationBackend(StrEnum):
+    scalar = "scalar"  # LendingAMM per sample
+    batch = "batch"  # BatchLendingAMM for many samples at once, ConstantInitialLiquidity only
+
+
 class Simulator:
+    batch_size = 10_000  # samples simulated together by the batch backend
+    initial_y0 = 1.0  # 1 ETH deposited in every window
+    # Instance settings which simulators of worker processes get from the parent, see get_settings
+    SETTINGS = ("samples", "min_loan_duration", "max_loan_duration", "log_enabled", "verbose", "skip_quiet_windows")
 
     def __init__(
         self,
@@ -30,6 +54,8 @@ class Simulator:
         max_loan_duration: maximum duration of loan in liquidation days (actual is chosen randomly every run)
         log_enabled: enable logging
         verbose: Output losses after each iteration for every run
+        skip_quiet_windows: don't trade through windows which never reach deposited bands (see QuietWindowIndex)
+        result_cache: memoize results of get_top_losses on disk (see ResultCache)
 
         Usually positions are in liquidation in < 30 min so 1/48 is reasonable approximation
         """
@@ -45,14 +71,20 @@ class Simulator:
         self.max_loan_duration = 1 / 24  # days
         self.log_enabled: bool = False
         self.verbose: bool = False
+        self.skip_quiet_windows: bool = True
+        self.result_cache: ResultCache | None = None
 
         self.prices = self.load_prices()
         self.oracle_prices = self.calculate_oracle_price(self.prices)
+        self._quiet_window_index: QuietWindowIndex | None = None
+        self._data_digests: tuple[str, str] | None = None
+        # (A, initial_liquidity_range, dynamic_fee_multiplier) -> initial AMM state at p0 = 1, see get_initial_state
+        self._initial_states: dict[tuple, tuple[LendingAMM, list[float]]] = {}
 
-    def load_prices(self) -> list:
+    def load_prices(self) -> list | PriceData:
         return self.price_history_loader.load_prices()
 
-    def calculate_oracle_price(self, prices: list) -> list:
+    def calculate_oracle_price(self, prices: list | PriceData) -> list | np.ndarray:
         return self.price_oracle.calculate_oracle_prices(prices)
 
     def single_run(
@@ -68,60 +100,76 @@ class Simulator:
         position: 0..1
         size: fraction of all price data length for size
         """
+        amm, initial_bands_x = self.simulate_window(
+            A, position_start, position_period, initial_liquidity_range, dynamic_fee_multiplier, position_shift
+        )
+        loss = 1 - amm.get_all_x() / sum(initial_bands_x)
+        return loss
+
+    def single_run_ranges(
+        self,
+        A: int,
+        position_start: float,
+        position_period: float,
+        initial_liquidity_ranges: list[int],
+        dynamic_fee_multiplier: float | None = None,
+        position_shift: float = 0,
+    ) -> list[float]:
+        """
+        Losses for every initial_liquidity_range in initial_liquidity_ranges from one simulation of the widest one
+
+        ConstantInitialLiquidity puts the same amount to every band, and AMM is linear in reserves, so the loss
+        of a narrower range is taken from values of its first bands. This is an approximation: target prices and
+        fees depend on the edges of the range, so trades which end beyond the narrower range are a bit different.
+        """
+        if self.initial_liquidity_class is not ConstantInitialLiquidity:
+            raise NotImplementedError("Band decomposition supports only ConstantInitialLiquidity")
+
+        amm, initial_bands_x = self.simulate_window(
+            A, position_start, position_period, max(initial_liquidity_ranges), dynamic_fee_multiplier, position_shift
+        )
+        return get_range_losses(initial_bands_x, amm.get_bands_x(), initial_liquidity_ranges).tolist()
+
+    def simulate_window(
+        self,
+        A: int,
+        position_start: float,
+        position_period: float,
+        initial_liquidity_range: int,
+        dynamic_fee_multiplier: float | None = None,
+        position_shift: float = 0,
+    ) -> tuple[LendingAMM, list[float]]:
+        """
+        Trade through the window, returns AMM in the final state and initial values of its bands
+        """
         # Data for prices
-        position_start_index = int(position_start * len(self.prices))  # start of position in prices array
-        position_end_index = int(
-            (position_start + position_period) * len(self.prices)
-        )  # end of position in prices array
+        position_start_index, position_end_index = self.get_position_indices(position_start, position_period)
 
         prices_for_simulation = self.prices[position_start_index:position_end_index]
         oracle_prices_for_simulation = self.oracle_prices[position_start_index:position_end_index]
+        if isinstance(oracle_prices_for_simulation, np.ndarray):
+            oracle_prices_for_simulation = oracle_prices_for_simulation.tolist()
         p0 = prices_for_simulation[0][1] * (1 - position_shift)
 
-        initial_y0 = 1.0  # 1 ETH
-        p_base = p0 * (A / (A - 1) + 1e-4)
-        initial_x_value = initial_y0 * p_base
-        amm = LendingAMM(p_base, A, dynamic_fee_multiplier)
+        amm, initial_bands_x = self.get_initial_state(A, initial_liquidity_range, dynamic_fee_multiplier, p0)
+        initial_x_value = self.initial_y0 * amm.p_base
 
-        # Fill ticks with liquidity
-        self.initial_liquidity_class(p0, initial_liquidity_range).deposit(amm, initial_y0)
-        initial_all_x = amm.get_all_x()
+        if self._can_skip(amm) and self.get_quiet_window_index().is_quiet_one(
+            position_start_index, position_end_index, amm.p_top(amm.min_band)
+        ):
+            # Reserves are not traded, only the oracle price changes
+            amm.set_p_oracle(oracle_prices_for_simulation[-1])
+            return amm, initial_bands_x
 
         xs_normalized = []
         fees = []
 
-        def find_target_price(p, is_up=True):
-            # Find target band
-            if is_up:
-                for n in range(amm.max_band, amm.min_band - 1, -1):
-                    p_down = amm.p_down(n)
-                    d_fee = amm.dynamic_fee(n)
-                    p_down_with_fee = p_down * (1 + d_fee)
-
-                    if p > p_down_with_fee:
-                        return p * (1 - d_fee)
-
-            else:
-                for n in range(amm.min_band, amm.max_band + 1):
-                    p_up = amm.p_up(n)
-                    d_fee = amm.dynamic_fee(n)
-                    p_up_ = p_up * (1 - d_fee)
-
-                    if p < p_up_:
-                        return p * (1 + d_fee)
-
-            # price is outside of liquidity
-            if is_up:
-                return p * (1 - amm.dynamic_fee(amm.min_band))
-            else:
-                return p * (1 + amm.dynamic_fee(amm.max_band))
-
         # <----------------- Calculation ----------------->
         for (t, open, high, low, close, vol), oracle_price in zip(prices_for_simulation, oracle_prices_for_simulation):
             amm.set_p_oracle(oracle_price)
 
-            high = find_target_price(high * (1 - self.external_fee), is_up=True)
-            low = find_target_price(low * (1 + self.external_fee), is_up=False)
+            high = amm.find_target_price(high * (1 - self.external_fee), is_up=True)
+            low = amm.find_target_price(low * (1 + self.external_fee), is_up=False)
 
             if high > amm.get_p():
                 amm.trade_to_price(high)
@@ -130,8 +178,8 @@ class Simulator:
             # if high > max_price:
             #     # Check that AMM has only stablecoins
             #     for n in range(amm.min_band, amm.max_band + 1):
-            #         assert amm.bands_y[n] == 0
-            #         assert amm.bands_x[n] > 0
+            #         assert amm.bands_y[n + amm.BAND_OFFSET] == 0
+            #         assert amm.bands_x[n + amm.BAND_OFFSET] > 0
 
             if low < amm.get_p():
                 amm.trade_to_price(low)
@@ -140,12 +188,12 @@ class Simulator:
             # if low < min_price:
             #     # Check that AMM has only collateral
             #     for n in range(amm.min_band, amm.max_band + 1):
-            #         assert amm.bands_x[n] == 0
-            #         assert amm.bands_y[n] > 0
+            #         assert amm.bands_x[n + amm.BAND_OFFSET] == 0
+            #         assert amm.bands_y[n + amm.BAND_OFFSET] > 0
 
-            d = datetime.fromtimestamp(t).strftime("%Y/%m/%d %H:%M")
             fees.append(amm.dynamic_fee(amm.active_band))
             if self.log_enabled:
+                d = datetime.fromtimestamp(t).strftime("%Y/%m/%d %H:%M")
                 current_x_total_normalized = amm.get_all_x() / initial_x_value
                 logger.info(
                     f"Current x total for {d}: {current_x_total_normalized:.4f}, oracle price: {oracle_price:.2f}, amm_price: {amm.get_p():.2f}"
@@ -158,13 +206,285 @@ class Simulator:
         if self.verbose:
             logger.info(f"Xs after trades list: {xs_normalized}")
 
-        loss = 1 - amm.get_all_x() / initial_all_x
-        return loss
+        return amm, initial_bands_x
+
+    @classmethod
+    def from_arrays(
+        cls,
+        prices: PriceData,
+        oracle_prices: np.ndarray,
+        initial_liquidity_class: type[BaseRangeInitialLiquidity],
+        external_fee: float,
+        settings: dict | None = None,
+    ) -> "Simulator":
+        """
+        Simulator of already loaded prices and calculated oracle prices
+        """
+        simulator = cls(
+            initial_liquidity_class=initial_liquidity_class,
+            price_history_loader=ArrayPriceHistoryLoader(prices),
+            price_oracle=PrecomputedPriceOracle(oracle_prices),
+            external_fee=external_fee,
+        )
+        simulator.set_settings(settings or {})
+        return simulator
+
+    def get_settings(self) -> dict:
+        return {name: getattr(self, name) for name in self.SETTINGS}
+
+    def set_settings(self, settings: dict) -> None:
+        for name, value in settings.items():
+            assert name in self.SETTINGS, f"Unknown simulator setting: {name}"
+            setattr(self, name, value)
+
+    def get_initial_state(
+        self, A: int, initial_liquidity_range: int, dynamic_fee_multiplier: float | None, p0: float
+    ) -> tuple[LendingAMM, list[float]]:
+        """
+        AMM with initial liquidity deposited at price p0 and initial values of its bands
+
+        The state is the same for every p0 up to the price level, so it is built once per parameter set at p0 = 1
+        and cloned for every window (initial liquidity classes must deposit relative to p0).
+        """
+        key = (A, initial_liquidity_range, dynamic_fee_multiplier)
+        if key not in self._initial_states:
+            amm = LendingAMM(A / (A - 1) + 1e-4, A, dynamic_fee_multiplier)
+            # Fill ticks with liquidity
+            self.initial_liquidity_class(1.0, initial_liquidity_range).deposit(amm, self.initial_y0)
+            self._initial_states[key] = (amm, amm.get_bands_x())
+
+        template, bands_x = self._initial_states[key]
+        return template.copy(p0 * template.p_base), [x * p0 for x in bands_x]
+
+    def _can_skip(self, amm: LendingAMM) -> bool:
+        # Logs are written per candle. Negative fees would let target prices exceed external ones
+        return self.skip_quiet_windows and not self.log_enabled and not self.verbose and amm.dynamic_fee_multiplier >= 0
+
+    def get_quiet_window_index(self) -> QuietWindowIndex:
+        if self._quiet_window_index is None:
+            prices, oracle_prices = self.get_price_arrays()
+            self._quiet_window_index = QuietWindowIndex(prices.high, oracle_prices, self.external_fee)
+        return self._quiet_window_index
+
+    def get_position_indices(self, position_start: float, position_period: float) -> tuple[int, int]:
+        """
+        Start and end of the position in prices array
+        """
+        return int(position_start * len(self.prices)), int((position_start + position_period) * len(self.prices))
+
+    def get_price_arrays(self) -> tuple[PriceData, np.ndarray]:
+        """
+        Prices and oracle prices as numpy arrays (converted if loaded as lists)
+        """
+        prices = self.prices if isinstance(self.prices, PriceData) else PriceData.from_rows(self.prices)
+        return prices, np.asarray(self.oracle_prices, dtype=np.float64)
+
+    def run_samples(
+        self,
+        run_kwargs: dict,
+        positions: list[tuple[float, float]],
+        n_top_samples: int,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> TopLosses:
+        """
+        Run single_run for every (position_start, position_period) and keep the n_top_samples largest losses
+
+        Failed runs are logged and count as zero loss
+        """
+        if backend == SimulationBackend.batch:
+            return self.run_samples_batch(run_kwargs, positions, n_top_samples)
+
+        top_losses = TopLosses(n_top_samples)
+        for position_start, position_period in positions:
+            start_index, end_index = self.get_position_indices(position_start, position_period)
+            try:
+                sr_result = self.single_run(
+                    position_start=position_start, position_period=position_period, **run_kwargs
+                )
+                if self.log_enabled:
+                    logger.info(
+                        f"Results A:{run_kwargs['A']}, position_start:{position_start}, "
+                        f"position_period:{position_period}: {sr_result}"
+                    )
+                top_losses.add(sr_result, start_index, end_index - start_index)
+            except Exception as e:
+                logger.warning(e)
+                top_losses.add(0, start_index, end_index - start_index)
+
+        return top_losses
+
+    def run_samples_batch(
+        self, run_kwargs: dict, positions: list[tuple[float, float]], n_top_samples: int
+    ) -> TopLosses:
+        """
+        Same as run_samples, but simulates batch_size positions at once with BatchLendingAMM
+        """
+        if self.initial_liquidity_class is not ConstantInitialLiquidity:
+            raise NotImplementedError("Batch backend supports only ConstantInitialLiquidity")
+
+        prices, oracle_prices = self.get_price_arrays()
+        top_losses = TopLosses(n_top_samples)
+        for i in range(0, len(positions), self.batch_size):
+            start_indices, end_indices = self._get_batch_indices(positions[i : i + self.batch_size])
+            losses = run_batch(
+                prices,
+                oracle_prices,
+                start_indices,
+                end_indices,
+                external_fee=self.external_fee,
+                quiet_window_index=self.get_quiet_window_index() if self.skip_quiet_windows else None,
+                **run_kwargs,
+            )
+            failed = np.isnan(losses)
+            if failed.any():
+                logger.warning(f"{failed.sum()} runs failed")
+            top_losses.add_many(np.where(failed, 0, losses), start_indices, end_indices - start_indices)
+
+        return top_losses
+
+    def _get_batch_indices(self, positions: list[tuple[float, float]]) -> tuple[np.ndarray, np.ndarray]:
+        position_start, position_period = np.array(positions).reshape(-1, 2).T
+        # Same indices as in single_run
+        start_indices = (position_start * len(self.prices)).astype(np.int64)
+        end_indices = ((position_start + position_period) * len(self.prices)).astype(np.int64)
+        return start_indices, end_indices
+
+    def run_samples_ranges(
+        self,
+        run_kwargs: dict,
+        positions: list[tuple[float, float]],
+        n_top_samples: int,
+        initial_liquidity_ranges: list[int],
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> dict[int, TopLosses]:
+        """
+        Same as run_samples for every initial liquidity range using single_run_ranges (band decomposition)
+
+        run_kwargs should not contain initial_liquidity_range
+        """
+        top_losses = {r: TopLosses(n_top_samples) for r in initial_liquidity_ranges}
+        if backend == SimulationBackend.batch:
+            if self.initial_liquidity_class is not ConstantInitialLiquidity:
+                raise NotImplementedError("Batch backend supports only ConstantInitialLiquidity")
+
+            prices, oracle_prices = self.get_price_arrays()
+            for i in range(0, len(positions), self.batch_size):
+                start_indices, end_indices = self._get_batch_indices(positions[i : i + self.batch_size])
+                losses = run_batch_ranges(
+                    prices,
+                    oracle_prices,
+                    start_indices,
+                    end_indices,
+                    initial_liquidity_ranges=initial_liquidity_ranges,
+                    external_fee=self.external_fee,
+                    quiet_window_index=self.get_quiet_window_index() if self.skip_quiet_windows else None,
+                    **run_kwargs,
+                )
+                failed = np.isnan(losses[:, 0])
+                if failed.any():
+                    logger.warning(f"{failed.sum()} runs failed")
+                losses = np.where(np.isnan(losses), 0, losses)
+                for j, r in enumerate(initial_liquidity_ranges):
+                    top_losses[r].add_many(losses[:, j], start_indices, end_indices - start_indices)
+            return top_losses
+
+        for position_start, position_period in positions:
+            start_index, end_index = self.get_position_indices(position_start, position_period)
+            try:
+                losses = self.single_run_ranges(
+                    position_start=position_start,
+                    position_period=position_period,
+                    initial_liquidity_ranges=initial_liquidity_ranges,
+                    **run_kwargs,
+                )
+            except Exception as e:
+                logger.warning(e)
+                losses = [0] * len(initial_liquidity_ranges)
+            for r, loss in zip(initial_liquidity_ranges, losses):
+                top_losses[r].add(loss, start_index, end_index - start_index)
+
+        return top_losses
+
+    def _map_chunks(
+        self,
+        task: Callable,
+        run_kwargs: dict,
+        positions: list[tuple[float, float]],
+        max_workers: int | None,
+        chunk_size: int,
+        *args,
+    ) -> Iterator:
+        """
+        Run task(t_exp, run_kwargs, chunk, *args) for chunks of positions in a worker_pool, yields results as completed
+        """
+        prices, oracle_prices = self.get_price_arrays()
+        # The pool has a single oracle series, any key works
+        t_exp = getattr(self.price_oracle, "t_exp", 0)
+
+        chunks = [positions[i : i + chunk_size] for i in range(0, len(positions), chunk_size)]
+        with worker_pool(
+            prices,
+            {t_exp: oracle_prices},
+            self.initial_liquidity_class,
+            self.external_fee,
+            self.get_settings(),
+            max_workers,
+        ) as pool:
+            futures = [pool.submit(task, t_exp, run_kwargs, chunk, *args) for chunk in chunks]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def run_samples_parallel(
+        self,
+        run_kwargs: dict,
+        positions: list[tuple[float, float]],
+        n_top_samples: int,
+        max_workers: int | None = None,
+        chunk_size: int = 2000,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> TopLosses:
+        """
+        Same as run_samples using a process pool, see _map_chunks
+        """
+        top_losses = TopLosses(n_top_samples)
+        for result in self._map_chunks(
+            _run_worker_samples, run_kwargs, positions, max_workers, chunk_size, n_top_samples, backend
+        ):
+            top_losses.merge(result)
+        return top_losses
+
+    def run_samples_ranges_parallel(
+        self,
+        run_kwargs: dict,
+        positions: list[tuple[float, float]],
+        n_top_samples: int,
+        initial_liquidity_ranges: list[int],
+        max_workers: int | None = None,
+        chunk_size: int = 2000,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> dict[int, TopLosses]:
+        """
+        Same as run_samples_ranges using a process pool, see _map_chunks
+        """
+        top_losses = {r: TopLosses(n_top_samples) for r in initial_liquidity_ranges}
+        for result in self._map_chunks(
+            _run_worker_samples_ranges,
+            run_kwargs,
+            positions,
+            max_workers,
+            chunk_size,
+            n_top_samples,
+            initial_liquidity_ranges,
+            backend,
+        ):
+            for r in initial_liquidity_ranges:
+                top_losses[r].merge(result[r])
+        return top_losses
 
     def single_run_kw(self, kw):
         return self.single_run(**kw)
 
-    def get_loss_rate(
+    def get_top_losses(
         self,
         A: int,
         initial_liquidity_range: int,
@@ -174,52 +494,387 @@ class Simulator:
         max_loan_duration: float | None = None,
         min_loan_duration: float | None = None,
         position_shift: float = 0,
-        use_threading: bool = False,  # somehow it's slower
-    ):
-        if not samples:
-            samples = self.samples
-        if not max_loan_duration:
-            max_loan_duration = self.max_loan_duration
-        if not min_loan_duration:
-            min_loan_duration = self.min_loan_duration
-
-        day_fraction = 86400 / (self.prices[-1][0] - self.prices[0][0])  # Which fraction of all data is 1 day
-
-        kwargs_list = []
-        for _ in range(samples):
-            position_start = random.random()
-            position_period = min_loan_duration * day_fraction
-            position_period += (max_loan_duration - min_loan_duration) * day_fraction * random.random()
-
-            kwargs_list.append(
-                {
-                    "A": A,
-                    "position_start": position_start,
-                    "position_period": position_period,
-                    "initial_liquidity_range": initial_liquidity_range,
-                    "dynamic_fee_multiplier": dynamic_fee_multiplier,
-                    "position_shift": position_shift,
-                }
-            )
+        sample_plan: SamplePlan | None = None,  # reuse the same windows, overrides samples and loan durations
+        seed: int | None = None,  # seed for a new sample plan
+        use_threading: bool = False,  # run samples in a process pool, see run_samples_parallel
+        max_workers: int | None = None,  # number of processes, defaults to cpu count
+        chunk_size: int = 2000,  # samples per task sent to a worker
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> TopLosses:
+        """
+        Simulate random positions and keep the n_top_samples largest losses with their windows
+        """
+        if sample_plan is None:
+            sample_plan = self.get_sample_plan(samples, min_loan_duration, max_loan_duration, seed)
+        positions = sample_plan.positions(self.get_day_fraction())
+        n_top_samples = n_top_samples or len(sample_plan) // 20
+
+        run_kwargs = {
+            "A": A,
+            "initial_liquidity_range": initial_liquidity_range,
+            "dynamic_fee_multiplier": dynamic_fee_multiplier,
+            "position_shift": position_shift,
+        }
+
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.get_key(self.get_result_params(run_kwargs, sample_plan, n_top_samples, backend))
+            top_losses = self.result_cache.load(key)
+            if top_losses is not None:
+                return top_losses
 
         if use_threading:
-            with ProcessPoolExecutor(max_workers=8) as pool:
-                results = pool.map(self.single_run_kw, kwargs_list)
+            top_losses = self.run_samples_parallel(
+                run_kwargs, positions, n_top_samples, max_workers, chunk_size, backend
+            )
         else:
-            results = []
-            for kw in kwargs_list:
-                try:
-                    sr_result = self.single_run(**kw)
-                    if self.log_enabled:
-                        logger.info(
-                            f"Results A:{kw['A']}, position_start:{kw['position_start']}, "
-                            f"position_period:{kw['position_period']}: {kw['sr_result']}"
-                        )
-                    results.append(sr_result)
-                except Exception as e:
-                    logger.warning(e)
-                    results.append(0)
-
-        if not n_top_samples:
-            n_top_samples = samples // 20
-        return sum(sorted(results)[::-1][:n_top_samples]) / n_top_samples
+            top_losses = self.run_samples(run_kwargs, positions, n_top_samples, backend)
+
+        if key is not None:
+            self.result_cache.save(key, top_losses, {**run_kwargs, "samples": len(sample_plan)})
+        return top_losses
+
+    def get_loss_rate_adaptive(
+        self,
+        A: int,
+        initial_liquidity_range: int,
+        dynamic_fee_multiplier: float | None = None,
+        tolerance: float = 0.05,  # relative half width of the confidence interval to stop at
+        confidence: float = 0.95,
+        samples: int | None = None,  # sample budget
+        n_top_samples: int | None = None,  # tail size at the full budget
+        batch_samples: int = 20_000,
+        max_loan_duration: float | None = None,
+        min_loan_duration: float | None = None,
+        position_shift: float = 0,
+        sample_plan: SamplePlan | None = None,  # overrides samples and loan durations
+        seed: int | None = None,
+        use_threading: bool = False,
+        max_workers: int | None = None,
+        chunk_size: int = 2000,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> dict:
+        """
+        Loss rate simulated in batches until it is known to a relative tolerance or the sample budget runs out
+
+        The metric is the tail mean of the same fraction of samples as get_loss_rate uses at the full budget
+        (n_top_samples / samples), its confidence interval is bootstrapped from the kept tail after each batch.
+        Batches are consecutive slices of one sample plan, so a run which uses the whole budget gives the same
+        loss as get_loss_rate with the same plan.
+        """
+        if sample_plan is None:
+            sample_plan = self.get_sample_plan(samples, min_loan_duration, max_loan_duration, seed)
+        day_fraction = self.get_day_fraction()
+        n_top_samples = n_top_samples or len(sample_plan) // 20
+        tail_fraction = n_top_samples / len(sample_plan)
+
+        run_kwargs = {
+            "A": A,
+            "initial_liquidity_range": initial_liquidity_range,
+            "dynamic_fee_multiplier": dynamic_fee_multiplier,
+            "position_shift": position_shift,
+        }
+
+        # Kept tail is twice the final one so that bootstrap resamples rarely run out of kept losses
+        top_losses = TopLosses(2 * n_top_samples)
+        result = {}
+        for batch_start in range(0, len(sample_plan), batch_samples):
+            positions = sample_plan[batch_start : batch_start + batch_samples].positions(day_fraction)
+            if use_threading:
+                batch = self.run_samples_parallel(
+                    run_kwargs, positions, top_losses.n_top, max_workers, chunk_size, backend
+                )
+            else:
+                batch = self.run_samples(run_kwargs, positions, top_losses.n_top, backend)
+            top_losses.merge(batch)
+
+            k = min(max(round(tail_fraction * top_losses.samples), 1), n_top_samples)
+            loss = top_losses.tail_mean(k)
+            low, high = top_losses.bootstrap_tail_mean(k, confidence=confidence, seed=seed)
+            result = {
+                "loss": loss,
+                "low": low,
+                "high": high,
+                "precision": (high - low) / 2,
+                "confidence": confidence,
+                "samples": top_losses.samples,
+                "n_top_samples": k,
+                "converged": (high - low) / 2 <= tolerance * loss,
+            }
+            logger.debug(f"Adaptive sampling: {result}")
+            if result["converged"]:
+                break
+        return result
+
+    def get_scan_plan(self, loan_durations: list[float] | None = None, stride: int = 1) -> SamplePlan:
+        """
+        Windows starting at every stride-th candle for every loan duration (days), consecutive starts together
+
+        Durations are rounded to whole candles and windows which would run past the end of data are left out.
+        Positions point to the middle of a candle, so they give exactly these start and end indices.
+        """
+        n_prices = len(self.prices)
+        candles_per_day = self.get_day_fraction() * n_prices
+        if loan_durations is None:
+            loan_durations = [self.min_loan_duration, self.max_loan_duration]
+
+        position_start = []
+        duration = []
+        for loan_duration in loan_durations:
+            n_candles = max(round(loan_duration * candles_per_day), 1)
+            start_indices = np.arange(0, n_prices - n_candles + 1, stride)
+            position_start.append((start_indices + 0.5) / n_prices)
+            duration.append(np.full(len(start_indices), n_candles / candles_per_day))
+        return SamplePlan(np.concatenate(position_start), np.concatenate(duration))
+
+    def get_worst_windows(
+        self,
+        A: int,
+        initial_liquidity_range: int,
+        dynamic_fee_multiplier: float | None = None,
+        loan_durations: list[float] | None = None,
+        stride: int = 1,
+        n_top_samples: int = 50,
+        **kwargs,  # position_shift and execution options of get_top_losses
+    ) -> TopLosses:
+        """
+        Exact n_top_samples worst windows of a deterministic scan over the whole history (see get_scan_plan)
+
+        Scans reuse the result cache, the process pool and the batch backend, whose batches of consecutive
+        starts share price and oracle slices and skip quiet windows without trading.
+        """
+        return self.get_top_losses(
+            A,
+            initial_liquidity_range,
+            dynamic_fee_multiplier,
+            n_top_samples=n_top_samples,
+            sample_plan=self.get_scan_plan(loan_durations, stride),
+            **kwargs,
+        )
+
+    def get_volatility_proposal(
+        self, mix: float = 0.1, power: float = 1.0, max_loan_duration: float | None = None
+    ) -> VolatilityProposal:
+        """
+        Importance sampling distribution of window starts, scored by volatility over the longest window
+        """
+        prices, _ = self.get_price_arrays()
+        horizon = int(np.ceil((max_loan_duration or self.max_loan_duration) * self.get_day_fraction() * len(prices)))
+        return VolatilityProposal(prices, max(horizon, 1), mix, power)
+
+    def get_loss_rate_importance(
+        self,
+        A: int,
+        initial_liquidity_range: int,
+        dynamic_fee_multiplier: float | None = None,
+        samples: int | None = None,
+        tail_fraction: float = 1 / 20,  # n_top_samples / samples of the uniform run to estimate
+        mix: float = 0.1,  # uniform share of the proposal, importance weights are at most 1 / mix
+        power: float = 1.0,  # sharpness of the proposal
+        max_loan_duration: float | None = None,
+        min_loan_duration: float | None = None,
+        seed: int | None = None,
+        **kwargs,  # position_shift and execution options of get_top_losses
+    ) -> float:
+        """
+        Loss rate with windows drawn from a volatility proposal and reweighted (see VolatilityProposal)
+
+        Estimates the same tail mean as get_loss_rate with uniform windows, with much fewer samples since
+        turbulent windows, which make the tail, are drawn much more often. Enough worst windows are kept to cover
+        the tail by weight even if all of them have the smallest weight (see VolatilityProposal.tail_size).
+        The unweighted worst windows found are get_top_losses with the same plan (worst case search).
+        """
+        proposal = self.get_volatility_proposal(mix, power, max_loan_duration)
+        sample_plan = proposal.generate_plan(
+            samples or self.samples,
+            min_loan_duration or self.min_loan_duration,
+            max_loan_duration or self.max_loan_duration,
+            seed,
+        )
+        top_losses = self.get_top_losses(
+            A,
+            initial_liquidity_range,
+            dynamic_fee_multiplier,
+            n_top_samples=proposal.tail_size(len(sample_plan), tail_fraction),
+            sample_plan=sample_plan,
+            **kwargs,
+        )
+        return proposal.tail_mean(top_losses, tail_fraction)
+
+    def get_data_digests(self) -> tuple[str, str]:
+        """
+        Content hashes of prices and oracle prices
+        """
+        if self._data_digests is None:
+            prices, oracle_prices = self.get_price_arrays()
+            oracle_digest = hashlib.blake2b(np.ascontiguousarray(oracle_prices).data, digest_size=16).hexdigest()
+            self._data_digests = (prices.digest(), oracle_digest)
+        return self._data_digests
+
+    def get_result_params(
+        self, run_kwargs: dict, sample_plan: SamplePlan, n_top_samples: int, backend: SimulationBackend
+    ) -> dict:
+        """
+        Everything the result of run_samples depends on, for ResultCache keys
+        """
+        prices_digest, oracle_digest = self.get_data_digests()
+        return {
+            "prices": prices_digest,
+            "oracle_prices": oracle_digest,
+            "initial_liquidity_class": self.initial_liquidity_class.__name__,
+            "external_fee": self.external_fee,
+            "run_kwargs": run_kwargs,
+            "sample_plan": sample_plan.digest(),
+            "n_top_samples": n_top_samples,
+            "backend": str(backend),
+        }
+
+    def get_top_losses_by_range(
+        self,
+        A: int,
+        initial_liquidity_ranges: list[int],
+        dynamic_fee_multiplier: float | None = None,
+        samples: int | None = None,
+        n_top_samples: int | None = None,
+        max_loan_duration: float | None = None,
+        min_loan_duration: float | None = None,
+        position_shift: float = 0,
+        sample_plan: SamplePlan | None = None,
+        seed: int | None = None,
+        use_threading: bool = False,
+        max_workers: int | None = None,
+        chunk_size: int = 2000,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> dict[int, TopLosses]:
+        """
+        Same as get_top_losses for every initial liquidity range, simulating only the widest one (approximate,
+        see single_run_ranges, logs a warning for ranges too narrow for A)
+        """
+        check_validated(A, initial_liquidity_ranges)
+        if sample_plan is None:
+            sample_plan = self.get_sample_plan(samples, min_loan_duration, max_loan_duration, seed)
+        positions = sample_plan.positions(self.get_day_fraction())
+        n_top_samples = n_top_samples or len(sample_plan) // 20
+
+        run_kwargs = {
+            "A": A,
+            "dynamic_fee_multiplier": dynamic_fee_multiplier,
+            "position_shift": position_shift,
+        }
+
+        if use_threading:
+            return self.run_samples_ranges_parallel(
+                run_kwargs, positions, n_top_samples, initial_liquidity_ranges, max_workers, chunk_size, backend
+            )
+        return self.run_samples_ranges(run_kwargs, positions, n_top_samples, initial_liquidity_ranges, backend)
+
+    def get_day_fraction(self) -> float:
+        """
+        Which fraction of all data is 1 day
+        """
+        return 86400 / (self.prices[-1][0] - self.prices[0][0])
+
+    def get_sample_plan(
+        self,
+        samples: int | None = None,
+        min_loan_duration: float | None = None,
+        max_loan_duration: float | None = None,
+        seed: int | None = None,
+    ) -> SamplePlan:
+        """
+        Draw simulation windows, simulator defaults are used for missing arguments
+        """
+        return SamplePlan.generate(
+            samples or self.samples,
+            min_loan_duration or self.min_loan_duration,
+            max_loan_duration or self.max_loan_duration,
+            seed,
+        )
+
+    def get_loss_rate(self, *args, **kwargs) -> float:
+        """
+        Average of the n_top_samples largest losses, takes the same arguments as get_top_losses
+
+        See get_loss_rate_adaptive to stop sampling once the loss rate is precise enough.
+        """
+        return self.get_top_losses(*args, **kwargs).mean()
+
+
+@contextmanager
+def worker_pool(
+    prices: PriceData,
+    oracle_prices: dict[int, np.ndarray],
+    initial_liquidity_class: type[BaseRangeInitialLiquidity],
+    external_fee: float,
+    settings: dict,
+    max_workers: int | None = None,
+) -> Iterator[ProcessPoolExecutor]:
+    """
+    Process pool whose workers have a Simulator for every t_exp of oracle_prices, see get_worker_simulator
+
+    Prices and oracle prices are put to shared memory once, every worker attaches them in its initializer,
+    and then only tasks (chunks of positions) are sent to workers.
+    """
+    arrays = dict(zip(PriceData.columns, prices.arrays()))
+    arrays.update({f"oracle_prices_{t_exp}": series for t_exp, series in oracle_prices.items()})
+    with SharedArrays(arrays) as shared_arrays:
+        with ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count(),
+            initializer=_init_worker,
+            initargs=(shared_arrays.specs, initial_liquidity_class, external_fee, settings),
+        ) as pool:
+            yield pool
+
+
+# Simulators of the worker process by t_exp, created once by _init_worker
+_worker_simulators: dict[int, Simulator] = {}
+_worker_blocks: list = []
+
+
+def _init_worker(
+    specs: SharedArraySpecs,
+    initial_liquidity_class: type[BaseRangeInitialLiquidity],
+    external_fee: float,
+    settings: dict,
+) -> None:
+    global _worker_blocks
+
+    arrays, _worker_blocks = SharedArrays.attach(specs)
+    prices = PriceData(*(arrays[c] for c in PriceData.columns))
+    for name, oracle_prices in arrays.items():
+        if name.startswith("oracle_prices_"):
+            t_exp = int(name.removeprefix("oracle_prices_"))
+            _worker_simulators[t_exp] = Simulator.from_arrays(
+                prices, oracle_prices, initial_liquidity_class, external_fee, settings
+            )
+
+
+def get_worker_simulator(t_exp: int) -> Simulator:
+    """
+    Simulator of a worker_pool worker
+    """
+    assert t_exp in _worker_simulators, "Worker is not initialized"
+    return _worker_simulators[t_exp]
+
+
+def _run_worker_samples(
+    t_exp: int,
+    run_kwargs: dict,
+    positions: list[tuple[float, float]],
+    n_top_samples: int,
+    backend: SimulationBackend,
+) -> TopLosses:
+    return get_worker_simulator(t_exp).run_samples(run_kwargs, positions, n_top_samples, backend)
+
+
+def _run_worker_samples_ranges(
+    t_exp: int,
+    run_kwargs: dict,
+    positions: list[tuple[float, float]],
+    n_top_samples: int,
+    initial_liquidity_ranges: list[int],
+    backend: SimulationBackend,
+) -> dict[int, TopLosses]:
+    return get_worker_simulator(t_exp).run_samples_ranges(
+        run_kwargs, positions, n_top_samples, initial_liquidity_ranges, backend
+    )
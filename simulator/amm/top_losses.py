@@ -0,0 +1,104 @@
+import heapq
+
+import numpy as np
+
+
+class TopLosses:
+    """
+    Streaming reducer keeping the n_top largest losses together with the windows which produced them
+
+    Memory is bounded by n_top (min-heap of (loss, start_index, duration)), reducers of different chunks
+    or workers are combined with merge().
+    """
+
+    def __init__(self, n_top: int):
+        self.n_top = n_top
+        self.heap: list[tuple[float, int, int]] = []
+        self.samples = 0  # number of losses seen
+
+    def add(self, loss: float, start_index: int, duration: int):
+        self.samples += 1
+        if len(self.heap) < self.n_top:
+            heapq.heappush(self.heap, (loss, start_index, duration))
+        elif loss > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (loss, start_index, duration))
+
+    def add_many(self, losses: np.ndarray, start_indices: np.ndarray, durations: np.ndarray):
+        """
+        Vectorized add: only losses which can get to the top are pushed to the heap
+        """
+        losses = np.asarray(losses, dtype=np.float64)
+        selected = np.arange(len(losses))
+        if len(self.heap) >= self.n_top:
+            selected = np.flatnonzero(losses > self.heap[0][0])
+        if len(selected) > self.n_top:
+            selected = selected[np.argpartition(-losses[selected], self.n_top - 1)[: self.n_top]]
+
+        self.samples += len(losses) - len(selected)
+        for i in selected.tolist():
+            self.add(float(losses[i]), int(start_indices[i]), int(durations[i]))
+
+    def merge(self, other: "TopLosses") -> "TopLosses":
+        assert self.n_top == other.n_top
+        for item in other.heap:
+            self.add(*item)
+        self.samples += other.samples - len(other.heap)
+        return self
+
+    def losses(self) -> list[float]:
+        """
+        Kept losses, largest first
+        """
+        return sorted((item[0] for item in self.heap), reverse=True)
+
+    def windows(self) -> list[dict]:
+        """
+        Kept windows, worst first
+        """
+        return [
+            {"loss": loss, "start_index": start_index, "duration": duration}
+            for loss, start_index, duration in sorted(self.heap, reverse=True)
+        ]
+
+    def mean(self) -> float:
+        """
+        Average of the n_top largest losses (missing samples count as zero loss)
+        """
+        return sum(self.losses()) / self.n_top
+
+    def tail_mean(self, k: int) -> float:
+        """
+        Average of the k largest losses seen, k should not exceed n_top
+        """
+        return sum(self.losses()[:k]) / k
+
+    def bootstrap_tail_mean(
+        self, k: int, n_resamples: int = 1000, confidence: float = 0.95, seed: int | None = None
+    ) -> tuple[float, float]:
+        """
+        Confidence interval (low, high) of tail_mean(k) by bootstrap over all samples seen
+
+        Only the kept losses matter for the top of a resample: every kept loss gets a binomial count of copies
+        (as in a multinomial resample of all samples), and the top k of the resample are taken from them.
+        If copies of kept losses are not enough, the rest is filled with the smallest kept loss, so n_top
+        should be well above k.
+        """
+        rng = np.random.default_rng(seed)
+        values = np.array(self.losses())
+        counts = rng.binomial(self.samples, 1 / self.samples, size=(n_resamples, len(values)))
+        before = np.cumsum(counts, axis=1) - counts
+        taken = np.clip(k - before, 0, counts)
+        sums = taken @ values + (k - taken.sum(axis=1)) * (values[-1] if len(values) else 0.0)
+        low, high = np.quantile(sums / k, [(1 - confidence) / 2, (1 + confidence) / 2])
+        return float(low), float(high)
+
+    def to_dict(self) -> dict:
+        return {"n_top": self.n_top, "samples": self.samples, "heap": [list(item) for item in self.heap]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TopLosses":
+        top_losses = cls(data["n_top"])
+        top_losses.samples = data["samples"]
+        top_losses.heap = [tuple(item) for item in data["heap"]]
+        heapq.heapify(top_losses.heap)
+        return top_losses
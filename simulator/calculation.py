@@ -3,11 +3,15 @@ import logging
 
 from numpy import log10, logspace
 
+from simulator.amm.checkpoint import Checkpoints
 from simulator.amm.intitial_liquidity import ConstantInitialLiquidity
 from simulator.amm.price_history_loader import GenericPriceHistoryLoader
-from simulator.amm.price_oracle import EmaPriceOracle
-from simulator.amm.simulator import Simulator
+from simulator.amm.result_cache import ResultCache
+from simulator.amm.sample_plan import SamplePlan
+from simulator.amm.simulator import SimulationBackend
+from simulator.optimizer import ParameterSearch
 from simulator.settings import BASE_DIR, Pair
+from simulator.sweep import Sweep, SweepGrid
 
 logger = logging.getLogger(__name__)
 
@@ -26,20 +30,19 @@ class Calculator:
         min_loan_duration: float | None = None,
         max_loan_duration: float | None = None,
         initial_liquidity_range: int = 4,
+        use_threading: bool = False,
+        backend: SimulationBackend = SimulationBackend.scalar,
+        seed: int | None = None,
+        sample_plan: SamplePlan | None = None,
+        resume: bool = False,
+        use_cache: bool = False,
+        checkpoint: bool = False,
     ):
-        price_oracle = EmaPriceOracle(t_exp=t_exp)
-        price_history_loader = GenericPriceHistoryLoader(pair=Pair(pair))
-
-        simulator = Simulator(
-            initial_liquidity_class=ConstantInitialLiquidity,
-            price_history_loader=price_history_loader,
-            price_oracle=price_oracle,
-            external_fee=cls.EXTERNAL_FEE,
-        )
-
-        losses = []
-        discounts = []
-
+        """
+        :param resume: continue unfinished points from checkpoints
+        :param use_cache: take finished points from the result cache and save new ones to it
+        :param checkpoint: save progress of unfinished points, to resume them after a crash
+        """
         kwargs = {
             "samples": samples,
             "n_top_samples": n_top_samples,
@@ -50,26 +53,21 @@ class Calculator:
         }
 
         a_range = [int(a) for a in logspace(log10(30), log10(500), 30)]
-        for a in a_range:
-            kwargs_with_a = {**kwargs, "A": a}
-            loss = simulator.get_loss_rate(**kwargs_with_a)
-
-            # Simplified formula
-            # bands_coefficient = (((A - 1) / A) ** range_size) ** 0.5
-            # More precise
-            bands_coefficient = (
-                sum(((a - 1) / a) ** (k + 0.5) for k in range(initial_liquidity_range)) / initial_liquidity_range
-            )
-            liquidation_discount = 1 - (1 - loss) * bands_coefficient
-
-            logger.info(f"Params: {kwargs_with_a}, loss: {loss}, liquidation discount: {liquidation_discount}")
-
-            losses.append(loss)
-            discounts.append(liquidation_discount)
+        grid = SweepGrid(
+            A=a_range,
+            initial_liquidity_range=initial_liquidity_range,
+            dynamic_fee_multiplier=dynamic_fee_multiplier,
+            t_exp=t_exp,
+        )
+        sweep = cls.get_sweep(pair, use_cache, checkpoint or resume)
+        if sample_plan is None:
+            sample_plan = cls.get_sample_plan(sweep, t_exp, samples, min_loan_duration, max_loan_duration, seed)
+        losses, discounts = cls.run_sweep(sweep, grid, sample_plan, n_top_samples, use_threading, backend, resume)
 
         results = [(a_range, losses), (a_range, discounts)]
 
         save_json_results(pair, f"losses_A__{samples}_{n_top_samples}", results)
+        save_sample_plan(pair, f"losses_A__{samples}_{n_top_samples}", sample_plan)
         save_plot(
             pair,
             f"losses_A__{samples}_{n_top_samples}",
@@ -91,20 +89,22 @@ class Calculator:
         dynamic_fee_multiplier: float | None = 0.25,
         min_loan_duration: float | None = None,
         max_loan_duration: float | None = None,
+        use_threading: bool = False,
+        backend: SimulationBackend = SimulationBackend.scalar,
+        seed: int | None = None,
+        sample_plan: SamplePlan | None = None,
+        band_decomposition: bool = False,
+        resume: bool = False,
+        use_cache: bool = False,
+        checkpoint: bool = False,
     ):
-        price_oracle = EmaPriceOracle(t_exp=t_exp)
-        price_history_loader = GenericPriceHistoryLoader(pair=Pair(pair))
-
-        simulator = Simulator(
-            initial_liquidity_class=ConstantInitialLiquidity,
-            price_history_loader=price_history_loader,
-            price_oracle=price_oracle,
-            external_fee=cls.EXTERNAL_FEE,
-        )
-
-        losses = []
-        discounts = []
-
+        """
+        :param band_decomposition: simulate only the widest range and derive the others from its bands,
+            one sweep instead of one per range, approximate (see Simulator.single_run_ranges)
+        :param resume: continue unfinished points from checkpoints (not used with band_decomposition)
+        :param use_cache: take finished points from the result cache and save new ones to it
+        :param checkpoint: save progress of unfinished points, to resume them after a crash
+        """
         kwargs = {
             "samples": samples,
             "n_top_samples": n_top_samples,
@@ -115,26 +115,39 @@ class Calculator:
         }
 
         liquidity_range = list(range(4, 50, 4))
-        for initial_liquidity_range in liquidity_range:
-            kwargs_with_a = {**kwargs, "initial_liquidity_range": initial_liquidity_range}
-            loss = simulator.get_loss_rate(**kwargs_with_a)
-
-            # Simplified formula
-            # bands_coefficient = (((A - 1) / A) ** range_size) ** 0.5
-            # More precise
-            bands_coefficient = (
-                sum(((a - 1) / a) ** (k + 0.5) for k in range(initial_liquidity_range)) / initial_liquidity_range
+        grid = SweepGrid(
+            A=a,
+            initial_liquidity_range=liquidity_range,
+            dynamic_fee_multiplier=dynamic_fee_multiplier,
+            t_exp=t_exp,
+        )
+        sweep = cls.get_sweep(pair, use_cache, checkpoint or resume)
+        if sample_plan is None:
+            sample_plan = cls.get_sample_plan(sweep, t_exp, samples, min_loan_duration, max_loan_duration, seed)
+
+        if band_decomposition:
+            top_losses_by_range = sweep.get_simulator(t_exp).get_top_losses_by_range(
+                A=a,
+                initial_liquidity_ranges=liquidity_range,
+                dynamic_fee_multiplier=dynamic_fee_multiplier,
+                n_top_samples=n_top_samples,
+                sample_plan=sample_plan,
+                use_threading=use_threading,
+                backend=backend,
             )
-            liquidation_discount = 1 - (1 - loss) * bands_coefficient
-
-            logger.info(f"Params: {kwargs_with_a}, loss: {loss}, liquidation discount: {liquidation_discount}")
-
-            losses.append(loss)
-            discounts.append(liquidation_discount)
+            losses = []
+            discounts = []
+            for point in grid.points():
+                loss = top_losses_by_range[point["initial_liquidity_range"]].mean()
+                losses.append(loss)
+                discounts.append(log_point_result(point, loss))
+        else:
+            losses, discounts = cls.run_sweep(sweep, grid, sample_plan, n_top_samples, use_threading, backend, resume)
 
         results = [(liquidity_range, losses), (liquidity_range, discounts)]
 
         save_json_results(pair, f"losses_initial_range__{samples}_{n_top_samples}", results)
+        save_sample_plan(pair, f"losses_initial_range__{samples}_{n_top_samples}", sample_plan)
         save_plot(
             pair,
             f"losses_range__{samples}_{n_top_samples}",
@@ -156,20 +169,19 @@ class Calculator:
         min_loan_duration: float | None = None,
         max_loan_duration: float | None = None,
         initial_liquidity_range: int = 4,
+        use_threading: bool = False,
+        backend: SimulationBackend = SimulationBackend.scalar,
+        seed: int | None = None,
+        sample_plan: SamplePlan | None = None,
+        resume: bool = False,
+        use_cache: bool = False,
+        checkpoint: bool = False,
     ):
-        price_oracle = EmaPriceOracle(t_exp=t_exp)
-        price_history_loader = GenericPriceHistoryLoader(pair=Pair(pair))
-
-        simulator = Simulator(
-            initial_liquidity_class=ConstantInitialLiquidity,
-            price_history_loader=price_history_loader,
-            price_oracle=price_oracle,
-            external_fee=cls.EXTERNAL_FEE,
-        )
-
-        losses = []
-        discounts = []
-
+        """
+        :param resume: continue unfinished points from checkpoints
+        :param use_cache: take finished points from the result cache and save new ones to it
+        :param checkpoint: save progress of unfinished points, to resume them after a crash
+        """
         kwargs = {
             "samples": samples,
             "n_top_samples": n_top_samples,
@@ -180,26 +192,21 @@ class Calculator:
         }
 
         d_fee_range = [d / 100 for d in range(10, 50, 3)]
-        for d_fee in d_fee_range:
-            kwargs_with_a = {**kwargs, "dynamic_fee_multiplier": d_fee}
-            loss = simulator.get_loss_rate(**kwargs_with_a)
-
-            # Simplified formula
-            # bands_coefficient = (((A - 1) / A) ** range_size) ** 0.5
-            # More precise
-            bands_coefficient = (
-                sum(((a - 1) / a) ** (k + 0.5) for k in range(initial_liquidity_range)) / initial_liquidity_range
-            )
-            liquidation_discount = 1 - (1 - loss) * bands_coefficient
-
-            logger.info(f"Params: {kwargs_with_a}, loss: {loss}, liquidation discount: {liquidation_discount}")
-
-            losses.append(loss)
-            discounts.append(liquidation_discount)
+        grid = SweepGrid(
+            A=a,
+            initial_liquidity_range=initial_liquidity_range,
+            dynamic_fee_multiplier=d_fee_range,
+            t_exp=t_exp,
+        )
+        sweep = cls.get_sweep(pair, use_cache, checkpoint or resume)
+        if sample_plan is None:
+            sample_plan = cls.get_sample_plan(sweep, t_exp, samples, min_loan_duration, max_loan_duration, seed)
+        losses, discounts = cls.run_sweep(sweep, grid, sample_plan, n_top_samples, use_threading, backend, resume)
 
         results = [(d_fee_range, losses), (d_fee_range, discounts)]
 
         save_json_results(pair, f"losses_dynamic_fee__{samples}_{n_top_samples}", results)
+        save_sample_plan(pair, f"losses_dynamic_fee__{samples}_{n_top_samples}", sample_plan)
         save_plot(
             pair,
             f"losses_dynamic_fee__{samples}_{n_top_samples}",
@@ -210,6 +217,147 @@ class Calculator:
         )
         return results
 
+    @classmethod
+    def optimize(
+        cls,
+        pair: str,
+        t_exp: int,
+        parameter: str = "A",
+        low: float = 30,
+        high: float = 500,
+        samples: int = 500000,
+        n_top_samples: int = 50,
+        a: int | None = None,
+        initial_liquidity_range: int = 4,
+        dynamic_fee_multiplier: float | None = 0.25,
+        min_loan_duration: float | None = None,
+        max_loan_duration: float | None = None,
+        use_threading: bool = False,
+        backend: SimulationBackend = SimulationBackend.scalar,
+        seed: int | None = None,
+        sample_plan: SamplePlan | None = None,
+        use_cache: bool = False,
+        **search_kwargs,
+    ) -> dict:
+        """
+        Value of parameter (A, initial_liquidity_range or dynamic_fee_multiplier) in [low, high] with minimal
+        liquidation discount, found with ParameterSearch instead of simulating a whole grid with all samples
+
+        :param use_cache: take simulated points from the result cache and save new ones to it
+        :param search_kwargs: stages, screening_points, stage_iterations, xtol of ParameterSearch
+        """
+        point = {
+            "A": a,
+            "initial_liquidity_range": initial_liquidity_range,
+            "dynamic_fee_multiplier": dynamic_fee_multiplier,
+            "t_exp": t_exp,
+            "min_loan_duration": min_loan_duration,
+            "max_loan_duration": max_loan_duration,
+        }
+        point[parameter] = low
+
+        sweep = cls.get_sweep(pair, use_cache)
+        if sample_plan is None:
+            sample_plan = cls.get_sample_plan(sweep, t_exp, samples, min_loan_duration, max_loan_duration, seed)
+        search = ParameterSearch(
+            sweep,
+            parameter,
+            low,
+            high,
+            objective=lambda p, loss: get_liquidation_discount(p["A"], p["initial_liquidity_range"], loss),
+            **search_kwargs,
+        )
+        result = search.run(point, sample_plan, n_top_samples, use_threading, backend)
+        logger.info(
+            f"Best {parameter}: {result['value']} (near optimal {result['near_optimal']}), "
+            f"liquidation discount: {result['objective']} {result['objective_interval']}, "
+            f"simulated {result['samples_simulated']} samples"
+        )
+
+        save_json_results(pair, f"optimize_{parameter}__{samples}_{n_top_samples}", result)
+        save_sample_plan(pair, f"optimize_{parameter}__{samples}_{n_top_samples}", sample_plan)
+        return result
+
+    @classmethod
+    def get_sweep(cls, pair: str, use_cache: bool = False, checkpoint: bool = False) -> Sweep:
+        """
+        :param use_cache: finished points are taken from the result cache, so re-running with the same seed
+            costs nothing. Results are cached by inputs, not by code, bump RESULT_CACHE_VERSION when results change
+        :param checkpoint: unfinished points are checkpointed
+        """
+        return Sweep(
+            price_history_loader=GenericPriceHistoryLoader(pair=Pair(pair), columnar=True),
+            initial_liquidity_class=ConstantInitialLiquidity,
+            external_fee=cls.EXTERNAL_FEE,
+            result_cache=ResultCache() if use_cache else None,
+            checkpoints=Checkpoints() if checkpoint else None,
+        )
+
+    @classmethod
+    def get_sample_plan(
+        cls,
+        sweep: Sweep,
+        t_exp: int,
+        samples: int,
+        min_loan_duration: float | None,
+        max_loan_duration: float | None,
+        seed: int | None,
+    ) -> SamplePlan:
+        """
+        Same windows for every value of the parameter
+        """
+        return sweep.get_simulator(t_exp).get_sample_plan(samples, min_loan_duration, max_loan_duration, seed)
+
+    @classmethod
+    def run_sweep(
+        cls,
+        sweep: Sweep,
+        grid: SweepGrid,
+        sample_plan: SamplePlan,
+        n_top_samples: int,
+        use_threading: bool,
+        backend: SimulationBackend,
+        resume: bool = False,
+    ) -> tuple[list[float], list[float]]:
+        """
+        Losses and liquidation discounts for every point of the grid (in grid order), logged as they are ready
+        """
+        points = grid.points()
+        losses = [0.0] * len(points)
+        discounts = [0.0] * len(points)
+        for point, top_losses in sweep.run(
+            grid,
+            samples=len(sample_plan),
+            n_top_samples=n_top_samples,
+            sample_plan=sample_plan,
+            use_processes=use_threading,
+            backend=backend,
+            resume=resume,
+        ):
+            i = points.index(point)
+            losses[i] = top_losses.mean()
+            discounts[i] = log_point_result(point, losses[i])
+        return losses, discounts
+
+
+def get_liquidation_discount(A: int, initial_liquidity_range: int, loss: float) -> float:
+    # Simplified formula
+    # bands_coefficient = (((A - 1) / A) ** range_size) ** 0.5
+    # More precise
+    bands_coefficient = (
+        sum(((A - 1) / A) ** (k + 0.5) for k in range(initial_liquidity_range)) / initial_liquidity_range
+    )
+    return 1 - (1 - loss) * bands_coefficient
+
+
+def log_point_result(point: dict, loss: float) -> float:
+    """
+    Log loss of a sweep point, returns its liquidation discount
+    """
+    liquidation_discount = get_liquidation_discount(point["A"], point["initial_liquidity_range"], loss)
+    logger.info(f"Params: {point}, loss: {loss}, liquidation discount: {liquidation_discount}")
+    return liquidation_discount
+
 
 def save_plot(
     pair: str,
@@ -266,3 +414,10 @@ def save_json_results(pair, file_name, results):
     path.parent.mkdir(parents=True, exist_ok=True)
     with open(path, "w") as f:
         json.dump(results, f)
+
+
+def save_sample_plan(pair: str, file_name: str, sample_plan: SamplePlan):
+    """
+    Windows used for the results, SamplePlan.load of this file reproduces the run exactly
+    """
+    sample_plan.save(BASE_DIR / "results" / pair / f"{file_name}.plan.npz")
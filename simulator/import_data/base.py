@@ -2,13 +2,20 @@ import asyncio
 import gzip
 import json
 import logging
+import os
 from abc import ABC, abstractmethod
 from datetime import datetime
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Iterator
+
+import numpy as np
 
 from simulator.settings import BASE_DIR, Pair
 
+from .cache import load_cached_columns, stat_fingerprint
+from .journal import ImportJournal
+from .partitions import PartitionedDataset, PartitionWriter
+
 logger = logging.getLogger(__name__)
 
 # Example DATA ETH-USD
@@ -27,7 +34,13 @@ logger = logging.getLogger(__name__)
 
 
 class BaseImporter(ABC):
+    """
+    The json.gz of a pair is the source of truth which is committed to the repository. Imports write a partitioned
+    dataset (a local, git ignored copy for fast and partial loads) and then export it to the json.gz
+    """
+
     interval = "1m"
+    interval_seconds = 60
 
     @property
     @abstractmethod
@@ -43,33 +56,176 @@ class BaseImporter(ABC):
 
     @classmethod
     def get_data_path(cls, pair: Pair) -> Path:
-        # Compress for saving in repo
+        # Committed data of the pair, loaded when there is no partitioned dataset exported to it
         return BASE_DIR / "data" / pair / f"{pair}-{cls.interval}-{cls.name}.json.gz"
 
     @classmethod
-    @abstractmethod
-    async def fetch(cls, pair: Pair) -> list[Any]: ...
+    def get_dataset(cls, pair: Pair) -> PartitionedDataset:
+        return PartitionedDataset(BASE_DIR / "data" / pair / f"{pair}-{cls.interval}-{cls.name}")
 
     @classmethod
-    def save(cls, pair: Pair, data: list[Any]) -> None:
+    def get_current_dataset(cls, pair: Pair) -> PartitionedDataset | None:
+        """
+        Partitioned dataset, unless the json.gz changed after it was exported (e.g. updated from the repository)
+        """
+        dataset = cls.get_dataset(pair)
+        if not dataset.exists():
+            return None
+        path = cls.get_data_path(pair)
+        if path.exists() and dataset.read_source() != stat_fingerprint(path):
+            logger.info(f"{path} doesn't match {dataset.path}, loading it (import_data --incremental converts it)")
+            return None
+        return dataset
+
+    @classmethod
+    def export_json(cls, pair: Pair) -> None:
+        """
+        Write rows of the dataset to the json.gz, partition by partition
+        """
+        dataset = cls.get_dataset(pair)
         path = cls.get_data_path(pair)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with gzip.open(path, "w") as f:
-            f.write(json.dumps(data).encode("utf-8"))
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        rows = (json.dumps([int(row[0]), *row[1:]]) for columns in dataset.iter_columns() for row in columns.T.tolist())
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(b"[")
+            for i, row in enumerate(rows):
+                f.write(f"{', ' if i else ''}{row}".encode("utf-8"))
+            f.write(b"]")
+        # Renaming keeps size and modification time
+        dataset.write_source(stat_fingerprint(tmp_path))
+        os.replace(tmp_path, path)
         logger.info(f"Saved data to {path}.")
 
     @classmethod
-    async def run_async(cls, pair: Pair) -> None:
-        logger.info(f"Fetching data for {pair}")
-        data = await cls.fetch(pair)
-        data = sorted(data, key=lambda x: x[0])
-        cls.save(pair, data)
+    @abstractmethod
+    def fetch(
+        cls, pair: Pair, ranges: list[tuple[int, int]] | None = None, journal: ImportJournal | None = None
+    ) -> AsyncIterator[list[Any]]:
+        """
+        Rows with open time in [start, end) seconds of every range (whole start..end if None), yielded in time order
+        in chunks as they are fetched. Windows fetched by an interrupted run are taken from the journal and new ones
+        are added to it
+        """
+
+    @classmethod
+    def save(cls, pair: Pair, data: list[Any]) -> None:
+        cls.get_dataset(pair).write(np.asarray(data, dtype=np.float64).reshape(len(data), -1).T)
+
+    @classmethod
+    def get_missing_ranges(cls, t: np.ndarray) -> list[tuple[int, int]]:
+        """
+        [start, end) ranges in seconds which are not in sorted times of rows: gaps between rows and the tail until end
+        """
+        t = np.asarray(t, dtype=np.int64)
+        gaps = np.flatnonzero(np.diff(t) > cls.interval_seconds)
+        ranges = [(int(t[i]) + cls.interval_seconds, int(t[i + 1])) for i in gaps]
+        end = int(cls.end.timestamp())
+        if len(t) == 0:
+            ranges.append((int(cls.start.timestamp()), end))
+        elif t[-1] + cls.interval_seconds < end:
+            ranges.append((int(t[-1]) + cls.interval_seconds, end))
+        return ranges
+
+    @classmethod
+    async def run_async(cls, pair: Pair, incremental: bool = False) -> None:
+        """
+        :param incremental: keep existing data and fetch only what is missing in it
+        """
+        path = cls.get_data_path(pair)
+        dataset = cls.get_dataset(pair)
+        ranges = None
+        if incremental and cls.get_current_dataset(pair) is None and path.exists():
+            # json.gz without partitions or changed after they were written
+            cls.save(pair, sorted(cls.load_json(pair), key=lambda x: x[0]))
+        if incremental and dataset.exists():
+            ranges = cls.get_missing_ranges(np.concatenate([c[0] for c in dataset.iter_columns()] or [[]]))
+            logger.info(f"Fetching {len(ranges)} missing ranges for {pair}")
+        else:
+            logger.info(f"Fetching data for {pair}")
+
+        # Rows are written as they come, only the current month and fetched ahead windows are in memory
+        journal = ImportJournal(path)
+        writer = PartitionWriter(dataset, merge=ranges is not None)
+        async for rows in cls.fetch(pair, ranges, journal):
+            writer.add(rows)
+        writer.close()
+        cls.export_json(pair)
+        journal.remove()
         logger.info(f"Fetched data for {pair}.")
 
     @classmethod
-    def run(cls, pair: Pair) -> None:
-        asyncio.run(cls.run_async(pair))
+    def run(cls, pair: Pair, incremental: bool = False) -> None:
+        asyncio.run(cls.run_async(pair, incremental))
 
     @classmethod
-    @abstractmethod
-    def load(cls, pair: Pair) -> list[Any]: ...
+    def load(cls, pair: Pair) -> list[Any]:
+        """
+        All rows [t, open, high, low, close, vol, quote vol]
+        """
+        dataset = cls.get_current_dataset(pair)
+        if dataset is None:
+            return cls.load_json(pair)
+        return [[int(row[0]), *row[1:]] for row in dataset.load().T.tolist()]
+
+    @classmethod
+    def load_json(cls, pair: Pair) -> list[Any]:
+        with gzip.open(cls.get_data_path(pair), "r") as f:
+            return json.load(f)
+
+    @classmethod
+    def get_time_range(cls, start_ts: int | None = None, end_ts: int | None = None) -> tuple[int, int]:
+        """
+        Intersection of [start_ts, end_ts) with the import range
+        """
+        start = int(cls.start.timestamp())
+        end = int(cls.end.timestamp())
+        return max(start, start_ts) if start_ts is not None else start, min(end, end_ts) if end_ts is not None else end
+
+    @classmethod
+    def load_columns(cls, pair: Pair, start_ts: int | None = None, end_ts: int | None = None) -> np.ndarray:
+        """
+        Rows within start..end (and start_ts..end_ts if given) as memory-mapped (n_columns, n_rows) float64 array
+
+        Only partitions which overlap the range are read. Older single file datasets are decoded once into
+        a binary cache next to the data file, later loads just map it.
+        """
+        start_ts, end_ts = cls.get_time_range(start_ts, end_ts)
+        dataset = cls.get_current_dataset(pair)
+        if dataset is not None:
+            return dataset.load(start_ts, end_ts)
+
+        columns = load_cached_columns(
+            cls.get_data_path(pair),
+            lambda: cls.load_json(pair),
+            int(cls.start.timestamp()),
+            int(cls.end.timestamp()),
+        )
+        inside = (columns[0] >= start_ts) & (columns[0] < end_ts)
+        return columns if inside.all() else columns[:, inside]
+
+    @classmethod
+    def get_fingerprint(cls, pair: Pair) -> dict:
+        """
+        Identifies the imported data: size and modification time of its files and the time of its last row
+        """
+        dataset = cls.get_current_dataset(pair)
+        if dataset is not None:
+            paths = [dataset.manifest_path] + [dataset.path / p["file"] for p in dataset.get_partitions()]
+        else:
+            paths = [cls.get_data_path(pair)]
+        return {
+            "files": {path.name: stat_fingerprint(path) for path in paths},
+            "last_t": max((int(c[0].max()) for c in cls.iter_columns(pair) if c.shape[1]), default=None),
+        }
+
+    @classmethod
+    def iter_columns(cls, pair: Pair, start_ts: int | None = None, end_ts: int | None = None) -> Iterator[np.ndarray]:
+        """
+        Columns in the range partition by partition, for data which doesn't fit in memory
+        """
+        start_ts, end_ts = cls.get_time_range(start_ts, end_ts)
+        dataset = cls.get_current_dataset(pair)
+        if dataset is not None:
+            yield from dataset.iter_columns(start_ts, end_ts)
+        else:
+            yield cls.load_columns(pair, start_ts, end_ts)
@@ -1,15 +1,15 @@
 import asyncio
 import datetime as dt
-import gzip
-import json
 import logging
-from typing import Any
+from typing import Any, AsyncIterator
 
 import aiohttp
 
-from simulator.settings import Pair
+from simulator.settings import BINANCE_BASE_URL, Pair
 
 from .base import BaseImporter
+from .journal import ImportJournal
+from .rate_control import AdaptiveConcurrency
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +20,16 @@ class BinanceImporter(BaseImporter):
     start: dt.datetime = dt.datetime(2021, 11, 1, tzinfo=dt.timezone.utc)
     end: dt.datetime = dt.datetime.now(dt.timezone.utc)
 
-    BINANCE_BASE_URL = "https://api.binance.com"
+    BINANCE_BASE_URL = BINANCE_BASE_URL
     KLINES_PATH = "/api/v3/klines"
     chunk_minutes: int = 288  # 1440 / 5
     limit: int = 500
-    concurrency: int = 8
+    concurrency: int = 8  # initial limit of requests in flight, adjusted to the weight budget if adaptive_concurrency
+    adaptive_concurrency: bool = True
+    weight_limit: int = 6000  # request weight per minute
+    request_weight: int = 2  # weight of a klines request with limit 500
+    USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-1M"
+    reorder_buffer: int = 64  # windows fetched ahead of the oldest one not yielded yet
     request_timeout: int = 30
     max_retries: int = 5
     backoff_base: float = 0.5  # seconds
@@ -36,12 +41,13 @@ class BinanceImporter(BaseImporter):
         return int(d.timestamp() * 1000)
 
     @classmethod
-    def _windows(cls) -> list[tuple[int, int]]:
+    def _windows(cls, start: dt.datetime | None = None, end: dt.datetime | None = None) -> list[tuple[int, int]]:
         windows: list[tuple[int, int]] = []
-        cur = cls.start
+        cur = start or cls.start
+        end = end or cls.end
         delta = dt.timedelta(minutes=cls.chunk_minutes)
-        while cur < cls.end:
-            nxt = min(cur + delta, cls.end)
+        while cur < end:
+            nxt = min(cur + delta, end)
             windows.append((cls._to_millis(cur), cls._to_millis(nxt) - 1))
             cur = nxt
         return windows
@@ -51,7 +57,9 @@ class BinanceImporter(BaseImporter):
         return f"{cls.BINANCE_BASE_URL}{cls.KLINES_PATH}"
 
     @classmethod
-    async def _fetch_window(cls, session: aiohttp.ClientSession, pair: Pair, start_ms: int, end_ms: int) -> list[Any]:
+    async def _fetch_window(
+        cls, session: aiohttp.ClientSession, controller: AdaptiveConcurrency, pair: Pair, start_ms: int, end_ms: int
+    ) -> list[Any]:
         params = {
             "symbol": pair,
             "interval": cls.interval,
@@ -59,8 +67,9 @@ class BinanceImporter(BaseImporter):
             "startTime": str(start_ms),
             "endTime": str(end_ms),
         }
-        result = await cls._request_with_retries(session, cls._base_url(), params)
+        result = await cls._request_with_retries(session, controller, cls._base_url(), params)
         logger.info(f"Fetched {pair} window for {start_ms} to {end_ms}")
+        controller.metrics.rows += len(result)
         return [
             [
                 r[0] // 1000,
@@ -75,11 +84,17 @@ class BinanceImporter(BaseImporter):
         ]
 
     @classmethod
-    async def _request_with_retries(cls, session: aiohttp.ClientSession, url: str, params: dict[str, str]) -> list[Any]:
+    async def _request_with_retries(
+        cls, session: aiohttp.ClientSession, controller: AdaptiveConcurrency, url: str, params: dict[str, str]
+    ) -> list[Any]:
+        """
+        Every attempt takes a slot of the controller, which also waits for the weight budget
+        """
         last_err: Exception | None = None
         for attempt in range(1, cls.max_retries + 1):
             try:
-                async with session.get(url, params=params, timeout=cls.request_timeout) as resp:
+                async with controller, session.get(url, params=params, timeout=cls.request_timeout) as resp:
+                    controller.on_response(resp.headers.get(cls.USED_WEIGHT_HEADER))
                     if resp.status in (418, 429):
                         # Rate limited or banned; respect Retry-After if present
                         retry_after = resp.headers.get("Retry-After")
@@ -95,25 +110,28 @@ class BinanceImporter(BaseImporter):
                             headers=resp.headers,
                         )
                         if attempt < cls.max_retries:
-                            await asyncio.sleep(delay)
+                            # Next attempts of all requests wait for the delay
+                            controller.on_rate_limited(delay)
                             continue
                         resp.raise_for_status()
                     resp.raise_for_status()
                     data = await resp.json()
                     # Binance error payloads may return JSON with code/msg but 200 OK for some errors; handle conservatively
-                    if isinstance(data, dict) and "code" in data and "msg" in data:
-                        # Treat as retryable for server codes
-                        last_err = RuntimeError(f"Binance error: {data}")
-                        if attempt < cls.max_retries:
-                            delay = cls.backoff_base * (2 ** (attempt - 1))
-                            await asyncio.sleep(delay)
-                            continue
-                        raise last_err
-                    return data
+                    if not (isinstance(data, dict) and "code" in data and "msg" in data):
+                        return data
+                # Treat as retryable for server codes, waiting after the slot and the connection are released
+                last_err = RuntimeError(f"Binance error: {data}")
+                if attempt < cls.max_retries:
+                    delay = cls.backoff_base * (2 ** (attempt - 1))
+                    controller.on_retry(delay)
+                    await asyncio.sleep(delay)
+                    continue
+                raise last_err
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 last_err = e
                 if attempt < cls.max_retries:
                     delay = cls.backoff_base * (2 ** (attempt - 1))
+                    controller.on_retry(delay)
                     await asyncio.sleep(delay)
                     continue
                 raise
@@ -122,28 +140,68 @@ class BinanceImporter(BaseImporter):
         raise last_err
 
     @classmethod
-    async def _bounded_fetch(
-        cls, sem: asyncio.Semaphore, session: aiohttp.ClientSession, pair: Pair, start_ms: int, end_ms: int
+    async def _journaled_fetch(
+        cls,
+        session: aiohttp.ClientSession,
+        controller: AdaptiveConcurrency,
+        pair: Pair,
+        start_ms: int,
+        end_ms: int,
+        journal: ImportJournal | None = None,
     ) -> list[Any]:
-        async with sem:
-            return await cls._fetch_window(session, pair, start_ms, end_ms)
+        rows = await cls._fetch_window(session, controller, pair, start_ms, end_ms)
+        if journal is not None:
+            journal.add(start_ms, end_ms, rows)
+        return rows
 
     @classmethod
-    async def fetch(cls, pair: Pair) -> list[Any]:
-        windows = cls._windows()
-        sem = asyncio.Semaphore(cls.concurrency)
+    async def fetch(
+        cls, pair: Pair, ranges: list[tuple[int, int]] | None = None, journal: ImportJournal | None = None
+    ) -> AsyncIterator[list[Any]]:
+        if ranges is None:
+            windows = cls._windows()
+        else:
+            windows = sorted(
+                window
+                for start, end in ranges
+                for window in cls._windows(
+                    dt.datetime.fromtimestamp(start, dt.timezone.utc), dt.datetime.fromtimestamp(end, dt.timezone.utc)
+                )
+            )
+        done = journal.load() if journal is not None else {}
+
+        controller = cls.get_controller()
         timeout = aiohttp.ClientTimeout(total=None)
         connector = aiohttp.TCPConnector(limit=0)
         async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-            tasks = [cls._bounded_fetch(sem, session, pair, s, e) for s, e in windows]
-            results: list[list[Any]] = await asyncio.gather(*tasks)
-        data: list[Any] = []
-        for chunk in results:
-            data.extend(chunk)
-        return data
+            # Windows finish in any order, they are yielded in order, at most reorder_buffer of them are scheduled
+            # ahead of the one being waited for
+            pending: dict[int, asyncio.Task] = {}
+            scheduled = 0
+            try:
+                for i, window in enumerate(windows):
+                    while scheduled < min(i + cls.reorder_buffer, len(windows)):
+                        if windows[scheduled] not in done:
+                            start_ms, end_ms = windows[scheduled]
+                            pending[scheduled] = asyncio.create_task(
+                                cls._journaled_fetch(session, controller, pair, start_ms, end_ms, journal)
+                            )
+                        scheduled += 1
+                    if window in done:
+                        yield journal.read(done[window])
+                    else:
+                        yield await pending.pop(i)
+            finally:
+                for task in pending.values():
+                    task.cancel()
+                logger.info(f"Import metrics: {controller.metrics.summary()}")
 
     @classmethod
-    def load(cls, pair: Pair) -> list[Any]:
-        path = cls.get_data_path(pair)
-        with gzip.open(path, "r") as f:
-            return json.load(f)
+    def get_controller(cls) -> AdaptiveConcurrency:
+        return AdaptiveConcurrency(
+            weight_limit=cls.weight_limit,
+            request_weight=cls.request_weight,
+            initial_limit=cls.concurrency,
+            max_limit=cls.reorder_buffer,
+            adaptive=cls.adaptive_concurrency,
+        )
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump when the binary layout changes, old caches are rebuilt
+CACHE_VERSION = 1
+
+
+def get_cache_paths(source_path: Path) -> tuple[Path, Path]:
+    """
+    Binary columns and json header are stored next to the source file
+    """
+    stem = source_path.name.split(".")[0]
+    return source_path.with_name(f"{stem}.cache.npy"), source_path.with_name(f"{stem}.cache.json")
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stat_fingerprint(path: Path) -> dict:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _effective_range(start_ts: int, end_ts: int, source_last_t: int) -> list[int]:
+    # Importer end is usually "now", so clamp it to the data we actually have
+    return [start_ts, min(end_ts, source_last_t + 1)]
+
+
+def _read_header(header_path: Path) -> dict | None:
+    try:
+        with open(header_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_header(header_path: Path, header: dict) -> None:
+    tmp_path = header_path.with_name(f"{header_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(header, f)
+    os.replace(tmp_path, header_path)
+
+
+def _is_valid(header: dict | None, header_path: Path, source_path: Path, start_ts: int, end_ts: int) -> bool:
+    if not header or header.get("version") != CACHE_VERSION:
+        return False
+
+    source = header["source"]
+    fingerprint = stat_fingerprint(source_path)
+    if fingerprint != {"size": source["size"], "mtime_ns": source["mtime_ns"]}:
+        # File was rewritten or touched: only the content hash can tell
+        if fingerprint["size"] != source["size"] or file_sha256(source_path) != source["sha256"]:
+            return False
+        header["source"].update(fingerprint)
+        _write_header(header_path, header)
+
+    return header["range"] == _effective_range(start_ts, end_ts, source["last_t"])
+
+
+def load_cached_columns(
+    source_path: Path,
+    decode: Callable[[], list[Any]],
+    start_ts: int,
+    end_ts: int,
+) -> np.ndarray:
+    """
+    Memory-mapped (n_columns, n_rows) float64 array with rows of the source dataset in [start_ts, end_ts)
+
+    First call decodes the source with `decode` and writes binary columns next to it. The cache is rebuilt
+    when the source file content, the import range or CACHE_VERSION changes.
+    Pages of the memory-mapped file are shared between processes by the OS page cache.
+    """
+    cache_path, header_path = get_cache_paths(source_path)
+    header = _read_header(header_path)
+
+    if cache_path.exists() and _is_valid(header, header_path, source_path, start_ts, end_ts):
+        return np.load(cache_path, mmap_mode="r")
+
+    logger.info(f"Building binary cache for {source_path}")
+    fingerprint = stat_fingerprint(source_path)
+    sha256 = file_sha256(source_path)
+    rows = np.asarray(decode(), dtype=np.float64)
+    source_last_t = int(rows[:, 0].max())
+
+    range_ = _effective_range(start_ts, end_ts, source_last_t)
+    rows = rows[(rows[:, 0] >= range_[0]) & (rows[:, 0] < range_[1])]
+    columns = np.ascontiguousarray(rows.T)
+
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, columns)
+    os.replace(tmp_path, cache_path)
+    _write_header(
+        header_path,
+        {
+            "version": CACHE_VERSION,
+            "source": {**fingerprint, "sha256": sha256, "last_t": source_last_t},
+            "range": range_,
+            "shape": list(columns.shape),
+        },
+    )
+    logger.info(f"Saved binary cache to {cache_path}.")
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+def load_derived_arrays(
+    source_path: Path,
+    fingerprint: dict,
+    params: dict,
+    build: Callable[[], dict[str, np.ndarray]],
+) -> dict[str, np.ndarray]:
+    """
+    Memory-mapped arrays derived from the dataset by `build`, cached next to source_path
+
+    fingerprint identifies the data (see BaseImporter.get_fingerprint), params the way arrays are derived from it.
+    Every (fingerprint, params) gets its own files, named by their digest, with a json header written last.
+    Caches of other fingerprints are stale and removed when a new one is built.
+    """
+    key = {"version": CACHE_VERSION, "fingerprint": fingerprint, "params": params}
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=8).hexdigest()
+    stem = source_path.name.split(".")[0]
+    header_path = source_path.with_name(f"{stem}.{digest}.cache.json")
+
+    header = _read_header(header_path)
+    if header is not None and header["key"] == key:
+        try:
+            return {name: np.load(header_path.with_name(file), mmap_mode="r") for name, file in header["files"].items()}
+        except OSError:
+            pass
+
+    for path in source_path.parent.glob(f"{stem}.*.cache.json"):
+        other = _read_header(path)
+        if path != header_path and (other is None or other["key"]["fingerprint"] != fingerprint):
+            path.unlink(missing_ok=True)
+            for file in (other or {}).get("files", {}).values():
+                path.with_name(file).unlink(missing_ok=True)
+
+    logger.info(f"Building binary cache {header_path.name}")
+    files = {}
+    for name, array in build().items():
+        files[name] = f"{stem}.{digest}.{name}.cache.npy"
+        tmp_path = header_path.with_name(f"{files[name]}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_path, header_path.with_name(files[name]))
+    _write_header(header_path, {"key": key, "files": files})
+
+    return {name: np.load(header_path.with_name(file), mmap_mode="r") for name, file in files.items()}
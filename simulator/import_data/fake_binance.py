@@ -0,0 +1,188 @@
+import asyncio
+import datetime as dt
+import logging
+import math
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from .journal import ImportJournal
+from .partitions import PartitionedDataset
+
+logger = logging.getLogger(__name__)
+
+
+class FakeKlinesServer:
+    """
+    Local stand-in of the Binance klines endpoint with a request weight budget, to benchmark imports offline
+
+    Weight is counted per window of `window` seconds (aligned as in AdaptiveConcurrency), requests above
+    weight_limit get 429 with Retry-After until the next window. Every response has the used weight header.
+    background_weight is used by other clients at the start of every window.
+    After fail_after requests (if set) every request gets 500, to interrupt imports.
+    Klines are synthetic, every minute from startTime to endTime has a row with close price(t).
+    """
+
+    def __init__(
+        self,
+        weight_limit: int = 6000,
+        request_weight: int = 2,
+        window: float = 60.0,
+        latency: float = 0.05,
+        background_weight: int = 0,
+    ):
+        self.weight_limit = weight_limit
+        self.request_weight = request_weight
+        self.window = window
+        self.latency = latency
+        self.background_weight = background_weight
+        self.window_start = 0.0
+        self.used_weight = 0
+        self.rejected = 0
+        self.requests = 0
+        self.fail_after: int | None = None
+        self.runner: web.AppRunner | None = None
+
+    @staticmethod
+    def price(t: int | np.ndarray) -> float | np.ndarray:
+        return 30000 + 1000 * np.sin(t / 86400)
+
+    async def klines(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.fail_after is not None and self.requests > self.fail_after:
+            return web.json_response({"code": -1001, "msg": "Internal error"}, status=500)
+
+        now = time.time()
+        window_start = now - now % self.window
+        if window_start != self.window_start:
+            self.window_start = window_start
+            self.used_weight = self.background_weight
+        self.used_weight += self.request_weight
+        headers = {"X-MBX-USED-WEIGHT-1M": str(self.used_weight)}
+        if self.used_weight > self.weight_limit:
+            self.rejected += 1
+            headers["Retry-After"] = str(math.ceil(window_start + self.window - now))
+            return web.json_response({"code": -1003, "msg": "Too many requests"}, status=429, headers=headers)
+
+        await asyncio.sleep(self.latency)
+        start = int(request.query["startTime"]) // 60000 * 60
+        end = int(request.query["endTime"]) // 1000
+        limit = int(request.query.get("limit", 500))
+        rows = []
+        for t in range(start, end + 1, 60)[:limit]:
+            p = float(self.price(t))
+            rows.append([t * 1000, str(p), str(p * 1.001), str(p * 0.999), str(p), "1.0", 0, str(p), 0, "0", "0", "0"])
+        return web.json_response(rows, headers=headers)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> str:
+        """
+        Returns base url of the server
+        """
+        app = web.Application()
+        app.router.add_get("/api/v3/klines", self.klines)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def benchmark_import(
+    importer_class: type,
+    days: float = 30,
+    adaptive: bool = True,
+    concurrency: int = 8,
+    weight_limit: int = 6000,
+    window: float = 60.0,
+    latency: float = 0.05,
+    background_weight: int = 0,
+) -> dict:
+    """
+    Fetch `days` of klines from a FakeKlinesServer with importer_class, returns its import metrics
+
+    Shows the throughput the adaptive limit gives up against high fixed limits, and the rate limited requests
+    (rejected) it avoids when other clients use background_weight (see manage.py benchmark_import).
+    """
+    server = FakeKlinesServer(weight_limit, importer_class.request_weight, window, latency, background_weight)
+    base_url = await server.start()
+    end = importer_class.start + dt.timedelta(days=days)
+    importer = type(
+        "BenchmarkImporter",
+        (importer_class,),
+        {
+            "BINANCE_BASE_URL": base_url,
+            "end": end,
+            "adaptive_concurrency": adaptive,
+            "concurrency": concurrency,
+            "weight_limit": weight_limit,
+        },
+    )
+    controller = importer.get_controller()
+    controller.window = window
+    importer.get_controller = classmethod(lambda cls: controller)
+    try:
+        async for _ in importer.fetch("BTCUSDT"):
+            pass
+    finally:
+        await server.stop()
+    return {**controller.metrics.summary(), "final_limit": controller.limit, "rejected": server.rejected}
+
+
+async def check_import(importer_class: type, days: float = 3, fail_after: int = 5) -> dict:
+    """
+    Import `days` of klines from a FakeKlinesServer to a temporary directory: interrupted after fail_after
+    requests, resumed, then extended by a day with an incremental import. Returns number of requests of every
+    step and whether the imported rows are the ones of the server
+    """
+    server = FakeKlinesServer()
+    base_url = await server.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp) / "CHECK-1m.json.gz"
+        importer = type(
+            "CheckImporter",
+            (importer_class,),
+            {
+                "BINANCE_BASE_URL": base_url,
+                "end": importer_class.start + dt.timedelta(days=days),
+                "max_retries": 1,
+                "get_data_path": classmethod(lambda cls, pair: data_path),
+                "get_dataset": classmethod(lambda cls, pair: PartitionedDataset(Path(tmp) / "CHECK-1m")),
+            },
+        )
+
+        def rows_equal() -> bool:
+            t = np.arange(importer.start.timestamp(), importer.end.timestamp(), importer.interval_seconds)
+            columns = importer.load_columns("CHECK")
+            return np.array_equal(columns[0], t) and np.array_equal(columns[4], server.price(t))
+
+        result = {"windows": len(importer._windows())}
+        try:
+            server.fail_after = fail_after
+            try:
+                await importer.run_async("CHECK")
+                result["interrupted"] = False
+            except aiohttp.ClientError:
+                result["interrupted"] = True
+            result["journaled_windows"] = len(ImportJournal(data_path).load())
+
+            server.fail_after = None
+            requests = server.requests
+            await importer.run_async("CHECK")
+            result["resume_requests"] = server.requests - requests
+            result["resume_equal"] = rows_equal() and not ImportJournal(data_path).path.exists()
+
+            importer.end += dt.timedelta(days=1)
+            requests = server.requests
+            await importer.run_async("CHECK", incremental=True)
+            result["incremental_requests"] = server.requests - requests
+            result["incremental_equal"] = rows_equal()
+        finally:
+            await server.stop()
+    return result
@@ -0,0 +1,56 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class ImportJournal:
+    """
+    Rows of fetched windows appended to a json lines file next to the dataset while an import runs
+
+    An interrupted import reads the journal and fetches only windows which are not in it. The journal is removed
+    once the dataset is saved. A line cut by a crash is ignored, so its window is fetched again.
+    """
+
+    def __init__(self, data_path: Path):
+        stem = data_path.name.split(".")[0]
+        self.path = data_path.with_name(f"{stem}.journal.jsonl")
+
+    def load(self) -> dict[tuple[int, int], int]:
+        """
+        (window start, window end) -> position of its rows in the journal, for windows fetched by previous runs
+
+        Rows are read by read() when they are needed, so resuming doesn't load everything fetched before.
+        """
+        done: dict[tuple[int, int], int] = {}
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    offset = f.tell()
+                    line = f.readline()
+                    if not line:
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    done[(entry["start"], entry["end"])] = offset
+        except OSError:
+            return done
+        logger.info(f"Resuming import from {self.path}: {len(done)} windows done.")
+        return done
+
+    def read(self, offset: int) -> list[Any]:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())["rows"]
+
+    def add(self, start: int, end: int, rows: list[Any]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"start": start, "end": end, "rows": rows}) + "\n")
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
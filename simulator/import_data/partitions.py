@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout changes
+PARTITIONS_VERSION = 1
+
+
+class PartitionedDataset:
+    """
+    Rows of a dataset split by calendar month (UTC), one binary (n_columns, n_rows) float64 .npy file per month
+
+    manifest.json lists the partitions with their time ranges, so loading a time range opens only the partitions
+    it overlaps (memory-mapped), and partitions can be processed one by one for data which doesn't fit in memory.
+    Partition files are never overwritten: every write gets a new file name, listed files change only together
+    with the manifest and files which are not listed anymore are removed after it is written.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.manifest_path = path / "manifest.json"
+        # Fingerprint of the exported json.gz the partitions have the same rows as, see BaseImporter.export_json
+        self.source_path = path / "source.json"
+
+    def exists(self) -> bool:
+        return self.manifest_path.exists()
+
+    def read_source(self) -> dict | None:
+        try:
+            with open(self.source_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_source(self, fingerprint: dict) -> None:
+        with open(self.source_path, "w") as f:
+            json.dump(fingerprint, f)
+
+    def read_manifest(self) -> dict:
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def write_manifest(self, n_columns: int, partitions: list[dict]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": PARTITIONS_VERSION, "n_columns": n_columns, "partitions": partitions}, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def write_partition(self, month: str, columns: np.ndarray) -> dict:
+        """
+        Save rows of one month to a new file, returns its manifest entry
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        file_name = f"{month}.{uuid.uuid4().hex[:8]}.npy"
+        tmp_path = self.path / f"{file_name}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(columns, dtype=np.float64))
+        os.replace(tmp_path, self.path / file_name)
+        return {
+            "month": month,
+            "file": file_name,
+            "rows": columns.shape[1],
+            "first_t": int(columns[0, 0]),
+            "last_t": int(columns[0, -1]),
+        }
+
+    def write(self, columns: np.ndarray) -> None:
+        """
+        Replace the dataset with (n_columns, n_rows) columns sorted by time
+        """
+        months = columns[0].astype(np.int64).astype("datetime64[s]").astype("datetime64[M]")
+        boundaries = np.flatnonzero(months[1:] != months[:-1]) + 1
+        partitions = [
+            self.write_partition(str(months[start]), columns[:, start:end])
+            for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(months)])
+            if end > start
+        ]
+        self.write_manifest(columns.shape[0], partitions)
+        self.remove_unlisted(partitions)
+        logger.info(f"Saved {len(partitions)} partitions to {self.path}.")
+
+    def remove_unlisted(self, partitions: list[dict]) -> None:
+        """
+        Remove partition files which are not listed: replaced ones and months which are not in the data anymore
+        """
+        for path in set(self.path.glob("*.npy")) - {self.path / p["file"] for p in partitions}:
+            path.unlink()
+
+    def get_partitions(self, start_ts: int | None = None, end_ts: int | None = None) -> list[dict]:
+        """
+        Manifest entries of partitions with rows in [start_ts, end_ts)
+        """
+        return [
+            p
+            for p in self.read_manifest()["partitions"]
+            if (start_ts is None or p["last_t"] >= start_ts) and (end_ts is None or p["first_t"] < end_ts)
+        ]
+
+    def iter_columns(self, start_ts: int | None = None, end_ts: int | None = None) -> Iterator[np.ndarray]:
+        """
+        Memory-mapped columns of every partition in the range, cut to the range
+        """
+        for partition in self.get_partitions(start_ts, end_ts):
+            columns = np.load(self.path / partition["file"], mmap_mode="r")
+            t = columns[0]
+            lo = 0 if start_ts is None else np.searchsorted(t, start_ts, side="left")
+            hi = len(t) if end_ts is None else np.searchsorted(t, end_ts, side="left")
+            yield columns[:, lo:hi]
+
+    def load(self, start_ts: int | None = None, end_ts: int | None = None) -> np.ndarray:
+        """
+        (n_columns, n_rows) columns in [start_ts, end_ts), not copied if they are in a single partition
+        """
+        parts = list(self.iter_columns(start_ts, end_ts))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.empty((self.read_manifest()["n_columns"], 0))
+        return np.concatenate(parts, axis=1)
+
+
+class PartitionWriter:
+    """
+    Writes rows arriving in time order to a PartitionedDataset, a partition as soon as its month is complete
+
+    Only rows of the current month are kept in memory. With merge, rows are merged into existing partitions
+    (new rows replace existing ones with the same time) and other partitions are kept, otherwise the dataset
+    is replaced. The manifest is written by close(), until then loads see the previous manifest and its
+    partitions, so an interrupted import leaves the dataset as it was.
+    """
+
+    def __init__(self, dataset: PartitionedDataset, merge: bool = False):
+        self.dataset = dataset
+        self.merge = merge
+        manifest = dataset.read_manifest() if merge and dataset.exists() else {"n_columns": None, "partitions": []}
+        self.n_columns: int | None = manifest["n_columns"]
+        self.partitions = {p["month"]: p for p in manifest["partitions"]}
+        self.written: set[str] = set()
+        self.rows: list[list[Any]] = []
+        self.month: str | None = None
+        self.month_start = 0
+        self.month_end = 0
+
+    def add(self, rows: list[list[Any]]) -> None:
+        for row in rows:
+            if not self.month_start <= row[0] < self.month_end:
+                self._flush()
+                month = np.datetime64(int(row[0]), "s").astype("datetime64[M]")
+                self.month = str(month)
+                self.month_start = int(month.astype("datetime64[s]").astype(np.int64))
+                self.month_end = int((month + 1).astype("datetime64[s]").astype(np.int64))
+            self.rows.append(row)
+
+    def _flush(self) -> None:
+        if not self.rows:
+            return
+        columns = np.asarray(self.rows, dtype=np.float64).T
+        self.rows = []
+        if self.merge and self.month in self.partitions:
+            existing = np.load(self.dataset.path / self.partitions[self.month]["file"])
+            columns = np.concatenate([existing, columns], axis=1)
+            columns = columns[:, np.argsort(columns[0], kind="stable")]
+            # Last row of every time, new rows come after existing ones
+            columns = columns[:, np.append(columns[0, 1:] != columns[0, :-1], True)]
+        self.n_columns = columns.shape[0]
+        self.partitions[self.month] = self.dataset.write_partition(self.month, columns)
+        self.written.add(self.month)
+
+    def close(self) -> None:
+        self._flush()
+        if not self.merge:
+            self.partitions = {month: p for month, p in self.partitions.items() if month in self.written}
+        partitions = [self.partitions[month] for month in sorted(self.partitions)]
+        self.dataset.write_manifest(self.n_columns or 0, partitions)
+        self.dataset.remove_unlisted(partitions)
+        logger.info(f"Saved {len(self.written)} partitions to {self.dataset.path}.")
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ImportMetrics:
+    """
+    Throughput of an import: rows, requests, retries and time requests spent waiting for the rate limit
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.rows = 0
+        self.requests = 0
+        self.retries = 0
+        self.backoff_time = 0.0  # seconds, summed over requests
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "rows_per_second": self.rows / elapsed if elapsed > 0 else 0.0,
+            "requests": self.requests,
+            "retries": self.retries,
+            "backoff_time": self.backoff_time,
+            "elapsed": elapsed,
+        }
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of requests in flight which follows the request weight budget of the API (AIMD)
+
+    While the used weight of the window is below target_usage of weight_limit, every response adds 1 / limit to the
+    limit (about +1 per round of requests). Above it more requests in flight don't fetch faster, so the limit is kept.
+    Rate limited responses halve the limit, at most once per round, and pause all requests for Retry-After.
+    Weight of requests is reserved before they are sent, so when the budget of the current window is used up,
+    requests wait for the next window instead of being rejected.
+    Windows are aligned to multiples of `window` seconds, as the per minute weight of the API.
+    With adaptive=False the limit stays fixed, only the pauses are kept.
+    """
+
+    def __init__(
+        self,
+        weight_limit: int,
+        request_weight: int = 1,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        target_usage: float = 0.8,
+        window: float = 60.0,
+        adaptive: bool = True,
+    ):
+        self.weight_limit = weight_limit
+        self.request_weight = request_weight
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_usage = target_usage
+        self.window = window
+        self.adaptive = adaptive
+        self.metrics = ImportMetrics()
+
+        self.in_flight = 0
+        self.used_weight = 0
+        self.window_start = 0.0
+        self.paused_until = 0.0
+        self._responses_since_decrease = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> "AdaptiveConcurrency":
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < max(int(self.limit), self.min_limit))
+            self.in_flight += 1
+
+        while True:
+            now = time.time()
+            self._update_window(now)
+            if now >= self.paused_until and self.used_weight + self.request_weight <= self.weight_limit:
+                break
+            wait = (self.paused_until if now < self.paused_until else self.window_start + self.window) - now
+            self.metrics.backoff_time += wait
+            await asyncio.sleep(wait)
+        self.used_weight += self.request_weight
+        self.metrics.requests += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _update_window(self, now: float) -> None:
+        window_start = now - now % self.window
+        if window_start != self.window_start:
+            self.window_start = window_start
+            self.used_weight = 0
+
+    def on_response(self, used_weight: str | None) -> None:
+        """
+        :param used_weight: used weight header of the response (X-MBX-USED-WEIGHT-1M for Binance)
+        """
+        if used_weight is not None:
+            self._update_window(time.time())
+            self.used_weight = max(self.used_weight, int(used_weight))
+        if not self.adaptive:
+            return
+
+        self._responses_since_decrease += 1
+        if self.used_weight < self.target_usage * self.weight_limit:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def on_rate_limited(self, delay: float) -> None:
+        # Time of the pause is counted by requests waiting for it
+        self.metrics.retries += 1
+        self.paused_until = max(self.paused_until, time.time() + delay)
+        if self.adaptive and self._responses_since_decrease >= self.limit:
+            self._decrease()
+
+    def on_retry(self, delay: float) -> None:
+        self.metrics.retries += 1
+        self.metrics.backoff_time += delay
+
+    def _decrease(self) -> None:
+        self.limit = max(self.limit / 2, self.min_limit)
+        self._responses_since_decrease = 0
+        logger.debug(f"Concurrency limit decreased to {self.limit:.1f}, used weight {self.used_weight}")
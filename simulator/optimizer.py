@@ -0,0 +1,160 @@
+import logging
+from math import exp, log, sqrt
+from typing import Callable
+
+import numpy as np
+
+from simulator.amm.sample_plan import SamplePlan
+from simulator.amm.simulator import SimulationBackend
+from simulator.amm.top_losses import TopLosses
+from simulator.sweep import Sweep, SweepGrid
+
+logger = logging.getLogger(__name__)
+
+GOLDEN_RATIO = (sqrt(5) - 1) / 2
+
+# Search axis of parameters: log scale for multiplicative ones, rounding for integer ones
+SEARCH_PARAMETERS = {
+    "A": {"log_scale": True, "integer": True},
+    "initial_liquidity_range": {"log_scale": False, "integer": True},
+    "dynamic_fee_multiplier": {"log_scale": False, "integer": False},
+}
+
+
+class ParameterSearch:
+    """
+    Minimum of an objective of the loss over one sweep parameter, other parameters fixed
+
+    The first stage evaluates a coarse grid on a small prefix of the sample plan and brackets the best value,
+    every next stage narrows the bracket by golden-section search on a longer prefix, the last one uses the whole
+    plan and runs until the bracket is narrower than xtol. All evaluations within a stage use the same windows
+    (common random numbers), so they differ by the parameter rather than by sampling noise.
+    """
+
+    def __init__(
+        self,
+        sweep: Sweep,
+        parameter: str,
+        low: float,
+        high: float,
+        objective: Callable[[dict, float], float] | None = None,  # (point, loss) -> value to minimize
+        stages: tuple[float, ...] = (1 / 16, 1 / 4, 1),  # fractions of the sample plan
+        screening_points: int = 8,
+        stage_iterations: int = 3,  # golden-section steps of intermediate stages
+        xtol: float | None = None,  # bracket width to stop at, on the search axis (log for log scale)
+        max_iterations: int = 30,
+    ):
+        assert parameter in SEARCH_PARAMETERS, f"Can't search {parameter}"
+        self.sweep = sweep
+        self.parameter = parameter
+        self.low = low
+        self.high = high
+        self.objective = objective or (lambda point, loss: loss)
+        self.stages = stages
+        self.screening_points = screening_points
+        self.stage_iterations = stage_iterations
+        self.max_iterations = max_iterations
+
+        self.log_scale = SEARCH_PARAMETERS[parameter]["log_scale"]
+        self.integer = SEARCH_PARAMETERS[parameter]["integer"]
+        if xtol is None:
+            xtol = 0.02 if self.log_scale else 1 if self.integer else (high - low) / 100
+        self.xtol = xtol
+
+    def to_axis(self, value: float) -> float:
+        return log(value) if self.log_scale else value
+
+    def from_axis(self, u: float) -> float:
+        value = exp(u) if self.log_scale else u
+        return int(round(value)) if self.integer else float(value)
+
+    def run(
+        self,
+        point: dict,  # fixed parameters, as accepted by SweepGrid
+        sample_plan: SamplePlan,
+        n_top_samples: int,  # tail size for the whole plan, prefixes keep the same tail fraction
+        use_processes: bool = False,
+        backend: SimulationBackend = SimulationBackend.scalar,
+    ) -> dict:
+        """
+        Best value found with its loss and objective (with bootstrap confidence intervals), the final bracket,
+        the range of values whose objective is within the confidence interval of the best one, and all evaluations
+        """
+        evaluations = []
+
+        def evaluate(values: list[float], samples: int, results: dict[float, tuple[float, TopLosses, int]]) -> None:
+            """
+            Objective, top losses and tail size of every value not evaluated in this stage yet, on the first samples
+            of the plan
+            """
+            values = sorted(set(values) - set(results))
+            if not values:
+                return
+            grid = SweepGrid(**{**point, self.parameter: values})
+            n_top = max(round(n_top_samples * samples / len(sample_plan)), 1)
+            # Kept tail is twice the evaluated one so that bootstrap resamples rarely run out of kept losses
+            for p, top_losses in self.sweep.run(
+                grid,
+                samples=samples,
+                n_top_samples=2 * n_top,
+                sample_plan=sample_plan[:samples],
+                use_processes=use_processes,
+                backend=backend,
+            ):
+                value = self.objective(p, top_losses.tail_mean(n_top))
+                results[p[self.parameter]] = (value, top_losses, n_top)
+                evaluations.append({"samples": samples, self.parameter: p[self.parameter], "objective": value})
+                logger.info(f"Search {self.parameter}: {p[self.parameter]}, samples: {samples}, objective: {value}")
+
+        # Screening
+        samples = max(round(self.stages[0] * len(sample_plan)), 1)
+        stage_results: dict[float, tuple[float, TopLosses, int]] = {}
+        grid_values = sorted(
+            {
+                self.from_axis(u)
+                for u in np.linspace(self.to_axis(self.low), self.to_axis(self.high), self.screening_points)
+            }
+        )
+        evaluate(grid_values, samples, stage_results)
+        best = min(range(len(grid_values)), key=lambda i: stage_results[grid_values[i]][0])
+        a = self.to_axis(grid_values[max(best - 1, 0)])
+        b = self.to_axis(grid_values[min(best + 1, len(grid_values) - 1)])
+
+        # Golden-section refinement
+        for stage, fraction in enumerate(self.stages[1:], 1):
+            samples = max(round(fraction * len(sample_plan)), 1)
+            stage_results = {}
+            is_last = stage == len(self.stages) - 1
+            iterations = self.max_iterations if is_last else self.stage_iterations
+            for _ in range(iterations):
+                if is_last and b - a <= self.xtol:
+                    break
+                c = b - GOLDEN_RATIO * (b - a)
+                d = a + GOLDEN_RATIO * (b - a)
+                x_c, x_d = self.from_axis(c), self.from_axis(d)
+                evaluate([x_c, x_d], samples, stage_results)
+                if stage_results[x_c][0] < stage_results[x_d][0]:
+                    b = d
+                else:
+                    a = c
+            evaluate([self.from_axis(a), self.from_axis(b)], samples, stage_results)
+
+        best_x = min(stage_results, key=lambda x: stage_results[x][0])
+        objective, top_losses, n_top = stage_results[best_x]
+        best_point = SweepGrid(**{**point, self.parameter: best_x}).points()[0]
+        loss_low, loss_high = top_losses.bootstrap_tail_mean(n_top)
+        objective_high = max(self.objective(best_point, loss_low), self.objective(best_point, loss_high))
+        near_optimal = [x for x, (value, _, _) in stage_results.items() if value <= objective_high]
+
+        return {
+            "parameter": self.parameter,
+            "value": best_x,
+            "bracket": [self.from_axis(a), self.from_axis(b)],
+            "near_optimal": [min(near_optimal), max(near_optimal)],
+            "loss": top_losses.tail_mean(n_top),
+            "loss_interval": [loss_low, loss_high],
+            "objective": objective,
+            "objective_interval": sorted([self.objective(best_point, loss_low), self.objective(best_point, loss_high)]),
+            "samples_simulated": sum(evaluation["samples"] for evaluation in evaluations),
+            "evaluations": evaluations,
+        }
@@ -1,8 +1,21 @@
+import os
 from enum import StrEnum
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Derived data which can always be recomputed (oracle series, simulation results, ...)
+CACHE_DIR = BASE_DIR / "cache"
+
+# Simulation results memoized by content hash of their inputs, least recently used are removed above the size
+RESULT_CACHE_DIR = CACHE_DIR / "results"
+RESULT_CACHE_MAX_SIZE = 256 * 2**20  # bytes
+# Progress of unfinished simulations, to resume after a crash
+CHECKPOINT_DIR = CACHE_DIR / "checkpoints"
+
+# Can point to a local stub of the klines endpoint
+BINANCE_BASE_URL = os.environ.get("BINANCE_BASE_URL", "https://api.binance.com")
+
 
 class Pair(StrEnum):
     BTCUSDT = "BTCUSDT"
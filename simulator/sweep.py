@@ -0,0 +1,283 @@
+import itertools
+import logging
+import random
+from concurrent.futures import as_completed
+from typing import Any, Iterator
+
+import numpy as np
+
+from simulator.amm.checkpoint import Checkpoints
+from simulator.amm.intitial_liquidity import BaseRangeInitialLiquidity, ConstantInitialLiquidity
+from simulator.amm.price_data import PriceData
+from simulator.amm.price_history_loader import BasePriceHistoryLoader
+from simulator.amm.price_oracle import EmaPriceOracle
+from simulator.amm.result_cache import ResultCache
+from simulator.amm.sample_plan import SamplePlan
+from simulator.amm.simulator import SimulationBackend, Simulator, get_worker_simulator, worker_pool
+from simulator.amm.top_losses import TopLosses
+
+logger = logging.getLogger(__name__)
+
+
+class SweepGrid:
+    """
+    Cartesian product of parameter values, every point is a dict with all PARAMETERS
+
+    SweepGrid(A=[30, 50, 100], initial_liquidity_range=4) - 3 points, single values don't need a list
+    """
+
+    PARAMETERS = {
+        "A": None,
+        "initial_liquidity_range": 4,
+        "dynamic_fee_multiplier": None,
+        "t_exp": 600,
+        "min_loan_duration": None,
+        "max_loan_duration": None,
+        "position_shift": 0,
+    }
+
+    def __init__(self, **axes: Any):
+        unknown = set(axes) - set(self.PARAMETERS)
+        assert not unknown, f"Unknown sweep parameters: {unknown}"
+        assert "A" in axes, "A is required"
+        self.axes = {
+            name: list(axes[name]) if isinstance(axes.get(name), (list, tuple, range)) else [axes.get(name, default)]
+            for name, default in self.PARAMETERS.items()
+        }
+
+    def points(self) -> list[dict]:
+        return [dict(zip(self.axes, values)) for values in itertools.product(*self.axes.values())]
+
+    def __len__(self) -> int:
+        return len(self.points())
+
+
+class Sweep:
+    """
+    Runs get_top_losses for every point of a SweepGrid, all points of the grid at once in a process pool
+
+    Prices are loaded once and oracle prices are calculated once per t_exp. In parallel mode they are put to
+    shared memory, and tasks are (point, chunk of samples), so cores are busy even when there are few points.
+    All points with the same loan durations use the same windows (common random numbers).
+    """
+
+    def __init__(
+        self,
+        price_history_loader: BasePriceHistoryLoader,
+        initial_liquidity_class: type[BaseRangeInitialLiquidity] = ConstantInitialLiquidity,
+        external_fee: float = 0.0,
+        result_cache: ResultCache | None = None,
+        checkpoints: Checkpoints | None = None,
+        simulator_settings: dict | None = None,
+    ):
+        """
+        :param simulator_settings: settings of the simulators (see Simulator.SETTINGS), in all processes
+        """
+        prices = price_history_loader.load_prices()
+        self.prices = prices if isinstance(prices, PriceData) else PriceData.from_rows(prices)
+        self.initial_liquidity_class = initial_liquidity_class
+        self.external_fee = external_fee
+        self.result_cache = result_cache
+        self.checkpoints = checkpoints
+        self.simulator_settings = simulator_settings or {}
+        self.oracle_prices: dict[int, np.ndarray] = {}
+        self.simulators: dict[int, Simulator] = {}
+        # (samples, min_loan_duration, max_loan_duration, seed) -> windows
+        self.sample_plans: dict[tuple, SamplePlan] = {}
+
+    def get_simulator(self, t_exp: int) -> Simulator:
+        if t_exp not in self.simulators:
+            self.simulators[t_exp] = Simulator.from_arrays(
+                self.prices,
+                self.get_oracle_prices([t_exp])[t_exp],
+                self.initial_liquidity_class,
+                self.external_fee,
+                self.simulator_settings,
+            )
+        return self.simulators[t_exp]
+
+    def get_oracle_prices(self, t_exps: list[int]) -> dict[int, np.ndarray]:
+        missing = sorted(set(t_exps) - set(self.oracle_prices))
+        if missing:
+            for t_exp, oracle_prices in zip(
+                missing, EmaPriceOracle.calculate_oracle_prices_multi(self.prices, missing)
+            ):
+                self.oracle_prices[t_exp] = oracle_prices
+        return {t_exp: self.oracle_prices[t_exp] for t_exp in t_exps}
+
+    def get_sample_plan(self, point: dict, samples: int, seed: int) -> SamplePlan:
+        simulator = self.get_simulator(point["t_exp"])
+        min_loan_duration = point["min_loan_duration"] or simulator.min_loan_duration
+        max_loan_duration = point["max_loan_duration"] or simulator.max_loan_duration
+        key = (samples, min_loan_duration, max_loan_duration, seed)
+        if key not in self.sample_plans:
+            self.sample_plans[key] = SamplePlan.generate(samples, min_loan_duration, max_loan_duration, seed)
+        return self.sample_plans[key]
+
+    def run(
+        self,
+        grid: SweepGrid,
+        samples: int,
+        n_top_samples: int | None = None,
+        seed: int | None = None,
+        sample_plan: SamplePlan | None = None,  # same windows for all points, overrides samples and loan durations
+        use_processes: bool = False,
+        max_workers: int | None = None,
+        chunk_size: int = 10_000,
+        backend: SimulationBackend = SimulationBackend.scalar,
+        resume: bool = False,  # continue unfinished points from checkpoints
+    ) -> Iterator[tuple[dict, TopLosses]]:
+        """
+        Yields (point, top losses) for every point of the grid as soon as the point is finished
+
+        Points are finished in grid order without use_processes, in any order otherwise.
+        Points found in result_cache are yielded first, results of the others are saved to it.
+        Samples are simulated in chunks of chunk_size, progress of points is saved to checkpoints until all of them
+        are finished.
+        """
+        if seed is None:
+            seed = random.getrandbits(63)
+        points = grid.points()
+        self.get_oracle_prices([point["t_exp"] for point in points])
+
+        point_plans = [
+            sample_plan if sample_plan is not None else self.get_sample_plan(point, samples, seed) for point in points
+        ]
+        n_top_samples = n_top_samples or len(point_plans[0]) // 20
+
+        keys = [
+            ResultCache.get_key(
+                self.get_simulator(point["t_exp"]).get_result_params(
+                    _get_run_kwargs(point), plan, n_top_samples, backend
+                )
+            )
+            for point, plan in zip(points, point_plans)
+        ]
+        todo = []
+        for i, point in enumerate(points):
+            cached = self.result_cache.load(keys[i]) if self.result_cache is not None else None
+            if cached is not None:
+                yield point, cached
+            else:
+                todo.append(i)
+
+        runs = []
+        for i in todo:
+            top_losses, done_chunks = TopLosses(n_top_samples), set()
+            if resume and self.checkpoints is not None:
+                top_losses, done_chunks = self.checkpoints.load(keys[i], chunk_size) or (top_losses, done_chunks)
+            runs.append(_PointRun(points[i], point_plans[i], keys[i], top_losses, done_chunks, chunk_size))
+
+        for run in self._run_points(runs, n_top_samples, use_processes, max_workers, backend):
+            if self.result_cache is not None:
+                self.result_cache.save(run.key, run.top_losses, {**run.point, "samples": len(run.plan)})
+            if self.checkpoints is not None:
+                # Finished points stay in checkpoints until the whole sweep is done, a resumed sweep doesn't
+                # simulate them again even without the result cache
+                self.checkpoints.save(run.key, run.top_losses, run.done_chunks, run.chunk_size, force=True)
+            yield run.point, run.top_losses
+
+        if self.checkpoints is not None:
+            for run in runs:
+                self.checkpoints.remove(run.key)
+
+    def _run_points(
+        self,
+        runs: list["_PointRun"],
+        n_top_samples: int,
+        use_processes: bool,
+        max_workers: int | None,
+        backend: SimulationBackend,
+    ) -> Iterator["_PointRun"]:
+        """
+        Simulates remaining chunks of points, yields runs as they are finished
+        """
+        for run in runs:
+            if not run.remaining_chunks():
+                yield run
+        runs = [run for run in runs if run.remaining_chunks()]
+        if not runs:
+            return
+
+        if not use_processes:
+            for run in runs:
+                simulator = self.get_simulator(run.point["t_exp"])
+                for chunk in run.remaining_chunks():
+                    self._add_chunk(
+                        run, chunk, _run_samples(simulator, run.point, run.get_chunk(chunk), n_top_samples, backend)
+                    )
+                yield run
+            return
+
+        pending = [0] * len(runs)
+        with worker_pool(
+            self.prices,
+            self.oracle_prices,
+            self.initial_liquidity_class,
+            self.external_fee,
+            self.simulator_settings,
+            max_workers,
+        ) as pool:
+            futures = {}
+            # Plan slices are sent instead of positions: a few numpy arrays are much cheaper to pickle
+            for i, run in enumerate(runs):
+                for chunk in run.remaining_chunks():
+                    future = pool.submit(_run_sweep_chunk, run.point, run.get_chunk(chunk), n_top_samples, backend)
+                    futures[future] = (i, chunk)
+                    pending[i] += 1
+
+            for future in as_completed(futures):
+                i, chunk = futures[future]
+                self._add_chunk(runs[i], chunk, future.result())
+                pending[i] -= 1
+                if pending[i] == 0:
+                    yield runs[i]
+
+    def _add_chunk(self, run: "_PointRun", chunk: int, top_losses: TopLosses) -> None:
+        run.top_losses.merge(top_losses)
+        run.done_chunks.add(chunk)
+        if self.checkpoints is not None:
+            self.checkpoints.save(run.key, run.top_losses, run.done_chunks, run.chunk_size)
+
+
+class _PointRun:
+    """
+    Progress of one point of a sweep: top losses of finished chunks of its sample plan
+    """
+
+    def __init__(
+        self, point: dict, plan: SamplePlan, key: str, top_losses: TopLosses, done_chunks: set[int], chunk_size: int
+    ):
+        self.point = point
+        self.plan = plan
+        self.key = key
+        self.top_losses = top_losses
+        self.done_chunks = done_chunks
+        self.chunk_size = chunk_size
+
+    def remaining_chunks(self) -> list[int]:
+        n_chunks = -(-len(self.plan) // self.chunk_size)
+        return [chunk for chunk in range(n_chunks) if chunk not in self.done_chunks]
+
+    def get_chunk(self, chunk: int) -> SamplePlan:
+        return self.plan[chunk * self.chunk_size : (chunk + 1) * self.chunk_size]
+
+
+def _get_run_kwargs(point: dict) -> dict:
+    return {
+        "A": point["A"],
+        "initial_liquidity_range": point["initial_liquidity_range"],
+        "dynamic_fee_multiplier": point["dynamic_fee_multiplier"],
+        "position_shift": point["position_shift"],
+    }
+
+
+def _run_samples(
+    simulator: Simulator, point: dict, plan: SamplePlan, n_top_samples: int, backend: SimulationBackend
+) -> TopLosses:
+    positions = plan.positions(simulator.get_day_fraction())
+    return simulator.run_samples(_get_run_kwargs(point), positions, n_top_samples, backend)
+
+
+def _run_sweep_chunk(point: dict, plan: SamplePlan, n_top_samples: int, backend: SimulationBackend) -> TopLosses:
+    return _run_samples(get_worker_simulator(point["t_exp"]), point, plan, n_top_samples, backend)
@@ -0,0 +1,21 @@
+import asyncio
+
+from simulator.import_data.binance import BinanceImporter
+from simulator.import_data.fake_binance import check_import
+
+
+def test_resumable_and_incremental_import():
+    """
+    Import interrupted by server errors is resumed from the journal, then extended by an incremental import,
+    both keep exactly the rows of the server
+    """
+    result = asyncio.run(check_import(BinanceImporter, days=3, fail_after=5))
+
+    assert result["interrupted"]
+    assert result["journaled_windows"] == 5
+    # Only windows which are not in the journal are requested again
+    assert result["resume_requests"] == result["windows"] - result["journaled_windows"]
+    assert result["resume_equal"]
+    # A day more is fetched from the end of the data, not the whole range
+    assert 0 < result["incremental_requests"] < result["windows"]
+    assert result["incremental_equal"]
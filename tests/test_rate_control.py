@@ -0,0 +1,106 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from simulator.import_data.binance import BinanceImporter
+from simulator.import_data.rate_control import AdaptiveConcurrency
+
+
+class FastRetryImporter(BinanceImporter):
+    backoff_base = 0.02
+
+
+async def request_scripted(controller: AdaptiveConcurrency, responses: list[web.Response]) -> tuple[list, int]:
+    """
+    One request of the importer to a server which answers with responses in order, returns its result
+    and number of requests the server got
+    """
+    requests = 0
+
+    async def klines(request: web.Request) -> web.Response:
+        nonlocal requests
+        requests += 1
+        return responses.pop(0)
+
+    app = web.Application()
+    app.router.add_get("/api/v3/klines", klines)
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url("/api/v3/klines"))
+        result = await FastRetryImporter._request_with_retries(session, controller, url, {})
+    return result, requests
+
+
+def test_limit_grows_below_target_usage():
+    controller = AdaptiveConcurrency(weight_limit=100, initial_limit=4, max_limit=5)
+    for _ in range(4):
+        controller.on_response("10")
+    assert controller.limit == pytest.approx(4.93, abs=0.01)
+
+    # Above target usage more requests in flight don't help
+    controller.on_response("90")
+    limit = controller.limit
+    controller.on_response("90")
+    assert controller.limit == limit
+
+    controller.used_weight = 0
+    for _ in range(10):
+        controller.on_response(None)
+    assert controller.limit == 5
+
+
+def test_rate_limited_halves_once_per_round():
+    controller = AdaptiveConcurrency(weight_limit=100, initial_limit=4)
+    for _ in range(4):
+        controller.on_response("90")
+    controller.on_rate_limited(1.0)
+    assert controller.limit == 2
+    # Other requests of the same round were rejected for the same reason
+    controller.on_rate_limited(1.0)
+    assert controller.limit == 2
+    assert controller.metrics.retries == 2
+
+    for _ in range(2):
+        controller.on_response("90")
+    controller.on_rate_limited(1.0)
+    assert controller.limit == 1
+    controller.on_response("90")
+    controller.on_rate_limited(1.0)
+    assert controller.limit == 1
+
+
+def test_fixed_limit():
+    controller = AdaptiveConcurrency(weight_limit=100, initial_limit=4, adaptive=False)
+    controller.on_response("10")
+    controller.on_response("90")
+    controller.on_rate_limited(0.5)
+    assert controller.limit == 4
+    assert controller.paused_until > 0
+
+
+def test_error_payload_and_rate_limited_responses():
+    """
+    Error payload is retried after backoff_base, 429 pauses the next attempt for Retry-After,
+    the time of both counts as backoff once
+    """
+    controller = AdaptiveConcurrency(weight_limit=100, request_weight=2, initial_limit=2)
+    headers = {BinanceImporter.USED_WEIGHT_HEADER: "90"}
+    responses = [
+        web.json_response({"code": -1001, "msg": "Internal error"}, headers=headers),
+        web.json_response(
+            {"code": -1003, "msg": "Too many requests"}, status=429, headers={**headers, "Retry-After": "0.1"}
+        ),
+        web.json_response([[0, "1", "1", "1", "1", "1", 0, "1"]], headers=headers),
+    ]
+    result, requests = asyncio.run(request_scripted(controller, responses))
+
+    assert result == [[0, "1", "1", "1", "1", "1", 0, "1"]]
+    assert requests == 3
+    assert controller.metrics.requests == 3
+    assert controller.metrics.retries == 2
+    # Two responses in a round of two requests, then the 429 halves the limit
+    assert controller.limit == 1
+    assert controller.metrics.backoff_time == pytest.approx(FastRetryImporter.backoff_base + 0.1, abs=0.03)
+    assert controller.in_flight == 0